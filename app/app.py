@@ -1,11 +1,16 @@
 from modules.properties import properties
 from modules.backend import data_socket
+from modules.backend.device_manager import DeviceManager, DeviceHandle
+from modules.backend.ingest import DataRecorder, TelemetryHub
 from modules.gui.segments import *
 import yaml
-import queue
 import os
+import collections
+import threading
 import time
 import ttkbootstrap
+import functools
+from typing import Optional, Callable
 
 
 class App(tk.Tk):
@@ -15,8 +20,13 @@ class App(tk.Tk):
         self.variables = properties.AppVariables()
         self.trackers = properties.AppTrackers()
         self.flags = properties.AppFlags()
-        self.data_buffers = properties.DataBuffers()
-        self.serial_lock = threading.Lock()
+        self.port_discovery = clinostat_com.PortDiscovery("temp/last_device.yaml")
+        self.device_view = 0  # Incremented every time the UI switches to showing another device.
+        self._loop_timer = None
+        self._wake_event = threading.Event()
+        self._calls = collections.deque()  # Callbacks from other threads, run by the program loop.
+        self.bind("<<ProgramLoop>>", lambda event: self.program_loop())
+        threading.Thread(target=self._wake_worker, daemon=True).start()
         ttkbootstrap.Style(theme="cosmo")
 
         if "saved data" not in os.listdir("."):
@@ -33,11 +43,27 @@ class App(tk.Tk):
         with open("config/config.yaml", "r") as file:
             config = yaml.load(file, Loader=yaml.FullLoader)
 
-        self.get_queue = queue.Queue()
-        self.put_queue = queue.Queue()
-        self.params["server"] = data_socket.DataServer(address=config["IP"], port=config["PORT"])
-        self.params["server"].attach_receive_queue(self.get_queue)
-        self.params["server"].attach_response_queue(self.put_queue)
+        self.buffer_capacities = config.get("DATA_BUFFER_CAPACITIES")
+        self.sample_rate = config.get("SAMPLE_RATE_HZ", 5)
+        self.spectrum_length = config.get("SPECTRUM_LENGTH", 300)
+        self.spectrum_window = config.get("SPECTRUM_WINDOW", "hann")
+        self.data_buffers = properties.DataBuffers(self.buffer_capacities)
+
+        self.heartbeat_interval = config["HEARTBEAT_INTERVAL"]
+        self.port_discovery.protocol = config["SERIAL_PROTOCOL"]
+        self.devices = DeviceManager(protocol=config["SERIAL_PROTOCOL"], heartbeat_interval=self.heartbeat_interval)
+
+        # Every consumer of the received samples subscribes to the hub. The plots may skip samples, the recorder
+        # writes every one of them to the data file. Its buffer is unbounded, a stalled disk must not hold up the
+        # server, the recorder catches up by writing everything that piled up at once.
+        self.telemetry = TelemetryHub()
+        self.get_queue = self.telemetry.subscribe("plots", maxsize=config["INGEST_BUFFER_SIZE"],
+                                                  policy=config["INGEST_POLICY"], notify=self.wake)
+        self.recorder = DataRecorder("temp/data.temp", self.telemetry.subscribe("data file", maxsize=None))
+        self.recorder.start()
+        self.params["server"] = data_socket.DataServer(address=config["IP"], port=config["PORT"],
+                                                       socket_path=config.get("SOCKET_PATH") or None)
+        self.params["server"].attach_receive_queue(self.telemetry)
 
         self.interface_manager = InterfaceManager(self)
         self.interface_manager.pack(expand=True)
@@ -47,59 +73,144 @@ class App(tk.Tk):
         if self.params["server"].running:
             self.params["server"].close_server()
 
-        if self.params["device"]:
-            self.params["device"].close_serial()
+        self.recorder.stop()  # Nothing is received anymore, the recorder writes what is left and ends.
+        self.devices.close_all()
+        self.recorder.join()
 
         super().quit()
 
     def clear_queues(self) -> None:
-        with self.get_queue.mutex:
-            self.get_queue.queue.clear()
-
-        with self.put_queue.mutex:
-            self.put_queue.queue.clear()
+        self.get_queue.clear()
 
     def reset_data_buffers(self) -> None:
-        self.data_buffers = properties.DataBuffers()
-
-    def device_likely_unplugged(self) -> None:
-
+        self.data_buffers = properties.DataBuffers(self.buffer_capacities)
+
+    def sync_active_device(self) -> None:
+        # params hold the device shown in the UI, the device manager keeps the rest.
+        handle = self.devices.active
+        self.params["device"] = handle.device if handle else None
+        self.params["serial_worker"] = handle.worker if handle else None
+        self.params["heartbeat"] = handle.heartbeat if handle else None
+        self.params["sequence"] = handle.sequence if handle else None
+
+    def select_device(self, port_name: str) -> None:
+        if self.devices.active is not None:
+            self.interface_manager.save_device_settings(self.devices.active)
+        self.devices.select(port_name)
+        self.show_active_device()
+
+    def show_active_device(self) -> None:
+        self.device_view += 1
+        self.sync_active_device()
+        self.interface_manager.ui_show_device(self.devices.active)
+        self.wake()  # Countdown of the shown device.
+
+    def device_callback(self, handle: DeviceHandle, callback: Optional[Callable]) -> Optional[Callable]:
+        # UI updates of a command only apply to the controls it was submitted from. If another device has been
+        # shown in the meantime, the controls are rebuilt from the device state instead.
+        if callback is None:
+            return None
+
+        view = self.device_view
+
+        def wrapper(*args):
+            if self.devices.active is not handle:
+                return
+            if self.device_view == view:
+                callback(*args)
+            else:
+                self.interface_manager.ui_device_state(handle)
+
+        return wrapper
+
+    def submit_command(self, handle: DeviceHandle, command: str, *args,
+                       at_start: Optional[Callable] = None,
+                       at_success: Optional[Callable] = None):
+        return handle.worker.submit(command, *args,
+                                    at_start=self.device_callback(handle, at_start),
+                                    at_success=self.device_callback(handle, at_success),
+                                    at_fail=functools.partial(self.device_likely_unplugged, handle))
+
+    def device_likely_unplugged(self, handle: Optional[DeviceHandle] = None) -> None:
+
+        handle = handle or self.devices.active
+        was_active = handle is self.devices.active
+        if handle is None or not self.devices.remove(handle):  # Already handled, e.g. by the heartbeat.
+            return
+
+        handle.stop_threads()
         try:
-            self.params["device"].close_serial()
+            handle.device.close_serial()
         except clinostat_com.ClinostatCommunicationError:
             pass
-        self.params["device"] = None
-        self.interface_manager.ui_modes_reset()
-        self.flags["pumping"] = False
-        self.trackers = properties.AppTrackers()
+
+        if was_active:
+            self.show_active_device()
+        else:
+            self.interface_manager.serial_config.update_device_menu()
 
     def reset_timers(self):
         pass
 
+    def wake(self) -> None:
+        # Runs the program loop on the Tk thread as soon as possible, safe to call from any thread. Calls made before
+        # the loop gets to run are merged into one.
+        self._wake_event.set()
+
+    def call_soon(self, callback: Callable, *args) -> None:
+        # Runs the callback on the Tk thread, for UI updates coming from the serial and server threads.
+        self._calls.append((callback, args))
+        self.wake()
+
+    def _wake_worker(self) -> None:
+        # The event is generated from this thread, not from the caller of wake: generating it waits for the Tk
+        # thread, which may itself be waiting for the caller (the server thread when the server is being closed).
+        while True:
+            self._wake_event.wait()
+            self._wake_event.clear()
+            try:
+                self.event_generate("<<ProgramLoop>>", when="tail")
+            except (tk.TclError, RuntimeError):  # Main loop not running yet or the window is being destroyed.
+                pass
+
     def program_loop(self) -> None:
 
-        if self.flags["plotting"] and not self.get_queue.empty():
-            self.params["plotter"].update_data()
+        # Runs when woken up by new data or a UI change, or at the nearest deadline it scheduled for itself (watering,
+        # countdown, pending redraw). Nothing runs while there is nothing to do.
+        if self._loop_timer is not None:
+            self.after_cancel(self._loop_timer)
+            self._loop_timer = None
 
-        if self.params["device"] and self.flags["pumping"]:
+        while self._calls:
+            callback, args = self._calls.popleft()
+            callback(*args)
 
-            now_time = time.time()
+        deadlines = []
 
-            if self.flags["prev_pumping_flag_state"] != self.flags["pumping"]:
-                self.trackers["seconds"] = now_time
-                self.trackers["pump_time"] = now_time
+        if self.flags["plotting"] and (not self.get_queue.empty() or self.params["plotter"].redraw_pending):
+            self.params["plotter"].update_data()
+        if self.flags["plotting"] and self.params["plotter"].redraw_pending:
+            deadlines.append(time.time() + self.params["plotter"].redraw_delay())
+
+        now_time = time.time()
 
+        for handle in self.devices.handles():
+            if handle.pumping and (now_time - handle.pump_time)/60 >= handle.water_interval:
+                self.interface_manager.pump_control.water_device(handle, handle.water_volume)
+                handle.pump_time = now_time
+            if handle.pumping:
+                deadlines.append(handle.pump_time + handle.water_interval*60)
+
+        active = self.devices.active
+        if active and active.pumping:
             if now_time - self.trackers["seconds"] >= 1:
-                time_left = self.variables["time1"].get()*60 - (now_time - self.trackers["pump_time"])
+                time_left = active.water_interval*60 - (now_time - active.pump_time)
                 minutes = int(time_left/60)
                 seconds = int(time_left - minutes*60)
                 self.variables["time_left_str"].set(f"{minutes:02d}:{seconds:02d}")
                 self.trackers["seconds"] = now_time
+            deadlines.append(self.trackers["seconds"] + 1)
 
-            if (now_time - self.trackers["pump_time"])/60 >= self.variables["time1"].get():
-                self.interface_manager.pump_control.force_watering_cycle()
-                self.trackers["pump_time"] = now_time
-
-        self.flags["prev_pumping_flag_state"] = self.flags["pumping"]
-
-        self.after(1, self.program_loop)
+        if deadlines:
+            delay_ms = max(1, int((min(deadlines) - time.time()) * 1000) + 1)  # Rounded up, not to wake up early.
+            self._loop_timer = self.after(delay_ms, self.program_loop)
@@ -1,10 +1,11 @@
 import queue
 import sensors
+import telemetry
 import socket
 import time
 import yaml
 import smbus
-from threading import Thread
+from threading import Thread, Lock
 from typing import Optional
 import gpiozero
 import os
@@ -33,6 +34,10 @@ class ChamberController:
     IMAGE_CAPTURE_INTERVAL_MINS = 60
     MOISTURE_LEVEL_MEASUREMENT_SAMPLES = 100
     DATA_EXCHANGE_FREQUENCY_HZ = 5
+    RECONNECT_DELAY_MIN_S = 0.5
+    RECONNECT_DELAY_MAX_S = 5
+    BATCH_SIZE = 1
+    BATCH_WINDOW_S = 0.
 
     def __init__(self):
         self._i2c_bus: smbus.SMBus = smbus.SMBus(1)
@@ -76,108 +81,199 @@ class ChamberController:
 
     def _control_loop(self) -> None:
 
+        reconnect_delay = ChamberController.RECONNECT_DELAY_MIN_S
+
+        while self._flags["running"]:
+            try:
+                sc = self._connect()
+            except OSError as err:
+                print(f"Connection failed ({err}), reconnection attempt in {reconnect_delay:.1f}s.")
+                time.sleep(reconnect_delay)
+                reconnect_delay = min(2 * reconnect_delay, ChamberController.RECONNECT_DELAY_MAX_S)
+                continue
+
+            reconnect_delay = ChamberController.RECONNECT_DELAY_MIN_S
+            with sc:
+                try:
+                    self._stream(sc)
+                except (OSError, ValueError) as err:
+                    print(f"Connection lost ({err}).")
+
+    def _connect(self) -> socket.socket:
+        # A unix socket when the server runs on the same machine, TCP otherwise.
+        if self._server_config["SOCKET_PATH"]:
+            print(f"Attempting connection to {self._server_config['SOCKET_PATH']}")
+            sc = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sc.settimeout(5)
+            try:
+                sc.connect(self._server_config["SOCKET_PATH"])
+            except OSError:
+                sc.close()
+                raise
+            return sc
+
+        print(f"Attempting connection to {self._server_config['IP']}")
+        sc = socket.create_connection((self._server_config["IP"], self._server_config["PORT"]), timeout=5)
+        sc.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sc
+
+    def _stream(self, sc: socket.socket) -> None:
+
+        # The connection stays open for the whole run. Samples are collected into batches, every batch is one frame.
+        # A batch is sent once it holds BATCH_SIZE samples or its first sample is BATCH_WINDOW_S old, whichever comes
+        # first, the window is waited out between samples. A window of 0 means no time limit. Light setpoints are
+        # pushed by the server and handled on a separate thread, servers without the control channel answer every
+        # batch instead. A new connection starts a new run.
+
+        sc.sendall(ChamberController._encode_frame(telemetry.encode_hello(telemetry.FORMATS + (telemetry.PUSH,))))
+        accepted = telemetry.decode_hello(ChamberController._receive_frame(sc).encode())
+        sample_format = accepted[0] if accepted else telemetry.TEXT  # Older servers answer with the default response.
+        batch_size = self._server_config["BATCH_SIZE"] if accepted else 1  # Older servers read one sample per frame.
+        batch_window = self._server_config["BATCH_WINDOW_S"]
+        push = bool(accepted) and telemetry.PUSH in accepted
+        print(f"Streaming samples as {sample_format}, up to {batch_size} per frame.")
+
+        send_lock = Lock()
+        if push:
+            Thread(target=self._receive_controls, args=(sc, send_lock), daemon=True).start()
+
+        batch = []
+        batch_deadline = None
+
         measurement_index = 0
         gravity_avg = [0, 0, 0]
+        self._current_run_images_dir = None
+        self._flags["moisture_measurement_scheduled"] = False
+
+        period = 1. / ChamberController.DATA_EXCHANGE_FREQUENCY_HZ
+        next_sample = time.monotonic()
+
+        while self._flags["running"]:
+
+            if measurement_index == 1:
+                date = str(datetime.datetime.now()).replace(" ", "-").replace(":", "-").replace(".", "-")
+                self._current_run_images_dir = "images/run_" + date
+                os.mkdir(self._current_run_images_dir)
+
+            self._trackers["current_timestamp"] = time.time()
+            if self._trackers["current_timestamp"] - self._trackers["last_measurement_timestamp"] >=\
+                    ChamberController.MOISTURE_LEVEL_MEASUREMENT_INTERVAL_MINS * 60\
+                    and self._sensors_driver_pin:
+                print("Scheduling saturation measurement.")
+                Thread(target=self._moisture_measurement, args=(self._data_queue,))
+                self._trackers["last_measurement_timestamp"] = self._trackers["current_timestamp"]
+
+            if self._trackers["current_timestamp"] - self._trackers["last_picture_timestamp"] >=\
+                    ChamberController.IMAGE_CAPTURE_INTERVAL_MINS * 60 and self._current_run_images_dir:
+                self._trackers["last_picture_timestamp"] = self._trackers["current_timestamp"]
+                Thread(target=self.take_pictures).start()
+
+            accel_values = self._sensors_short_read["GRAV"].read()
+            temperatures = [self._sensors_short_read[key].read() for key in ("TEMP1", "TEMP2", "TEMP3")]
+
+            if not self._data_queue.empty():
+                moisture_level = self._data_queue.get()
+                self._data_queue.task_done()
+            else:
+                moisture_level = telemetry.NO_HUMIDITY_READING
+
+            gravity_avg = [gravity_avg[ind] * measurement_index / (measurement_index + 1) + accel_values[ind] /
+                           (measurement_index + 1) for ind in range(3)]
+
+            sample = telemetry.Sample(measurement_index, time.time(),
+                                      accel_values + gravity_avg + temperatures + [moisture_level])
+            measurement_index += 1
+
+            if not batch:
+                batch_deadline = time.monotonic() + batch_window if batch_window > 0 else None
+            batch.append(sample)
+
+            if len(batch) >= batch_size or batch_deadline is not None and time.monotonic() >= batch_deadline:
+                self._send_batch(sc, batch, sample_format, push, send_lock)
+                batch = []
+
+            # Scheduled from the start of the run, so the time spent on the exchange doesn't lower the rate.
+            next_sample += period
+            if batch and batch_deadline is not None and batch_deadline < next_sample:
+                # The window runs out before the next sample, the partial batch is sent on time.
+                time.sleep(max(0., batch_deadline - time.monotonic()))
+                self._send_batch(sc, batch, sample_format, push, send_lock)
+                batch = []
+            delay = next_sample - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_sample = time.monotonic()  # Fell behind, don't send a burst to catch up.
 
-        while True:
+    def _send_batch(self, sc: socket.socket, batch: list, sample_format: str, push: bool, send_lock: Lock) -> None:
+        if push:
+            with send_lock:
+                sc.sendall(ChamberController._encode_frame(
+                    telemetry.KIND_SAMPLES + telemetry.encode_batch(batch, sample_format)))
+        else:
+            sc.sendall(ChamberController._encode_frame(telemetry.encode_batch(batch, sample_format)))
+            server_response = ChamberController._receive_frame(sc)
+            if server_response != ChamberController.DEFAULT_SERVER_RESPONSE:
+                self._set_lighting(*server_response.split(";"))
+
+    def _receive_controls(self, sc: socket.socket, send_lock: Lock) -> None:
+        # Runs until the connection is closed, the sending side notices it on its next frame.
+        try:
             while True:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sc:
-
-                    if measurement_index == 1:
-                        date = str(datetime.datetime.now()).replace(" ", "-").replace(":", "-").replace(".", "-")
-                        self._current_run_images_dir = "images/run_" + date
-                        os.mkdir(self._current_run_images_dir)
-
-                    sc.settimeout(5)
-                    try:
-                        print(f"Attempting connection to {self._server_config['IP']}")
-                        sc.connect((self._server_config["IP"], self._server_config["PORT"]))
-                    except socket.timeout:
-                        print("Connection timed out.")
-                        break
-                    except ConnectionRefusedError:
-                        measurement_index = 0
-                        gravity_avg = [0, 0, 0]  # Resetting the gravity averages.
-                        self._current_run_images_dir = None
-                        self._flags["moisture_measurement_scheduled"] = False
-                        print("Connection refused, reconnection attempt in 5s.")
-                        time.sleep(5)
-                        break  # Here interrupt the forever loop and continue to watch for the connection.
-
-                    self._trackers["current_timestamp"] = time.time()
-                    if self._trackers["current_timestamp"] - self._trackers["last_measurement_timestamp"] >=\
-                            ChamberController.MOISTURE_LEVEL_MEASUREMENT_INTERVAL_MINS * 60\
-                            and self._sensors_driver_pin:
-                        print("Scheduling saturation measurement.")
-                        Thread(target=self._moisture_measurement, args=(self._data_queue,))
-                        self._trackers["last_measurement_timestamp"] = self._trackers["current_timestamp"]
-
-                    if self._trackers["current_timestamp"] - self._trackers["last_picture_timestamp"] >=\
-                            ChamberController.IMAGE_CAPTURE_INTERVAL_MINS * 60 and self._current_run_images_dir:
-                        self._trackers["last_picture_timestamp"] = self._trackers["current_timestamp"]
-                        Thread(target=self.take_pictures).start()
-
-                    sensor_values = []
-                    for _, sensor in self._sensors_short_read.items():
-                        sensor_values += sensor.read()
-
-                    if not self._data_queue.empty():
-                        moisture_level = self._data_queue.get()
-                        sensor_values += [moisture_level]
-                        self._data_queue.task_done()
-                    else:
-                        sensor_values += [-100]
-
-                    accel_values = sensor_values[0]
-                    gravity_avg = [gravity_avg[ind] * measurement_index / (measurement_index + 1) + accel_values[ind] /
-                                   (measurement_index + 1) for ind in range(3)]
-                    measurement_index += 1
-
-                    sensor_values.insert(1, gravity_avg)
-
-                    msg = ";".join([str(val) for val in sensor_values]) + "\n"
-                    msg = f'{len(msg):<{ChamberController.PACKET_HEADER_SIZE}}' + msg
-
-                    fresh = True
-                    try:
-                        sc.sendall(msg.encode())
-                    except BrokenPipeError:
-                        measurement_index = 0
-                        gravity_avg = [0, 0, 0]
-                        self._current_run_images_dir = None
-                        self._flags["moisture_measurement_scheduled"] = False
-                        break
-
-                    server_response = ""
-
-                    while True:
-                        raw_data_received = sc.recv(ChamberController.PACKET_HEADER_SIZE)
-                        raw_data_received = raw_data_received.decode('utf-8')
-
-                        if fresh:
-                            packet_size = int(raw_data_received[:ChamberController.PACKET_HEADER_SIZE])
-                            fresh = False
-                            server_response += raw_data_received[ChamberController.PACKET_HEADER_SIZE:]
-                        else:
-                            server_response += raw_data_received
-
-                        if len(server_response) == packet_size:
-                            break
-                    response_components = server_response.split(";")
-                    if response_components[0] != ChamberController.DEFAULT_SERVER_RESPONSE and self._light_panel:
-                        self._light_panel.set_intensity(response_components[0], response_components[1])
-                        print("Adjusting lighting... ", int(response_components[0]), int(response_components[1]))
-
-                    time.sleep(1./ChamberController.DATA_EXCHANGE_FREQUENCY_HZ)
+                try:
+                    control = ChamberController._receive_frame(sc)
+                except socket.timeout:
+                    continue  # No setpoint changes for a while.
+                seq, values = telemetry.decode_control(control.encode())
+                self._set_lighting(*values)
+                with send_lock:
+                    sc.sendall(ChamberController._encode_frame(telemetry.encode_ack(seq)))
+        except (OSError, ValueError) as err:
+            print(f"Control channel closed ({err}).")
+            try:
+                sc.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _set_lighting(self, red: str, blue: str) -> None:
+        # Intensities come in percent.
+        if self._light_panel:
+            self._light_panel.set_intensity(float(red) / 100, float(blue) / 100)
+            print(f"Adjusting lighting... {float(red):.0f}% {float(blue):.0f}%")
+
+    @staticmethod
+    def _encode_frame(payload: bytes) -> bytes:
+        return f'{len(payload):<{ChamberController.PACKET_HEADER_SIZE}}'.encode() + payload
+
+    @staticmethod
+    def _receive_frame(sc: socket.socket) -> str:
+        packet_size = int(ChamberController._receive_exactly(sc, ChamberController.PACKET_HEADER_SIZE))
+        return ChamberController._receive_exactly(sc, packet_size, started=True).decode("utf-8")
+
+    @staticmethod
+    def _receive_exactly(sc: socket.socket, size: int, started: bool = False) -> bytes:
+        # A timeout is only raised before the first byte of a frame, once a frame has started it is read to the end.
+        data = bytearray()
+        while len(data) < size:
+            try:
+                chunk = sc.recv(size - len(data))
+            except socket.timeout:
+                if data or started:
+                    continue
+                raise
+            if not chunk:
+                raise ConnectionResetError("Server closed the connection.")
+            data += chunk
+        return bytes(data)
 
     def add_light_control(self, pin_red: int, pin_blue: int) -> None:
         self._light_panel = sensors.LightPanel(pin_red, pin_blue)
 
     def add_server_connection(self, ip_address: Optional[str] = None, port: Optional[int] = None) -> None:
-        if not ip_address or not port:
-            with open("../config/chamber_config.yaml", "r") as fl:
-                temp_config = yaml.load(fl, Loader=yaml.FullLoader)
+        with open("../config/chamber_config.yaml", "r") as fl:
+            temp_config = yaml.load(fl, Loader=yaml.FullLoader)
 
+        if not ip_address or not port:
             self._server_config["IP"] = temp_config["IP"]
             self._server_config["PORT"] = temp_config["PORT"]
 
@@ -185,6 +281,11 @@ class ChamberController:
             self._server_config["IP"] = ip_address
             self._server_config["PORT"] = port
 
+        self._server_config["SOCKET_PATH"] = temp_config.get("SOCKET_PATH") or None
+        self._server_config["BATCH_SIZE"] = max(1, int(temp_config.get("BATCH_SIZE", ChamberController.BATCH_SIZE)))
+        self._server_config["BATCH_WINDOW_S"] = float(temp_config.get("BATCH_WINDOW_S",
+                                                                      ChamberController.BATCH_WINDOW_S))
+
     def add_worker_pin(self, pin: int) -> None:
         self._sensors_driver_pin = gpiozero.Pin(pin)
         self._sensors_driver_pin.off()
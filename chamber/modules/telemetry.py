@@ -0,0 +1,91 @@
+import struct
+from typing import NamedTuple, Optional, Sequence, List, Tuple
+
+# Sample records sent by the chamber, shared with the server (modules/backend/data_socket.py).
+#
+# Right after connecting the chamber sends HELLO;<formats it can send, preferred first> and the server answers
+# HELLO;<chosen format>. A server that doesn't know HELLO answers it like a sample ("default") and a chamber that
+# doesn't send it gets the text format, so both sides fall back to text when talking to older versions.
+#
+# text - values joined with ";", newline terminated, no sequence number or timestamp.
+# bin1 - RECORD_V1: sequence number (uint32), unix timestamp (float64) and the SAMPLE_FIELDS as float32,
+#        little endian.
+#
+# A frame carries one or more samples (a batch) back to back, in either format. Batches are only sent after a
+# successful HELLO, servers that don't negotiate expect one sample per frame.
+#
+# Control channel. Without it the server answers every sample frame with either "default" or the light setpoint
+# "<red>;<blue>". A chamber that offers PUSH in its HELLO and sees it in the answer gets no answers to its samples.
+# Instead the server sends LIGHT;<seq>;<red>;<blue> as soon as the setpoint changes and the chamber acknowledges it.
+# All frames the chamber sends on such a connection start with a kind byte, KIND_SAMPLES or KIND_ACK.
+
+HELLO = "HELLO"
+TEXT = "text"
+BINARY_V1 = "bin1"
+FORMATS = (BINARY_V1, TEXT)
+PUSH = "push"
+
+LIGHT = "LIGHT"
+KIND_SAMPLES = b"S"
+KIND_ACK = b"A"
+
+SAMPLE_FIELDS = ("grav_x", "grav_y", "grav_z", "mean_x", "mean_y", "mean_z", "temp1", "temp2", "temp3", "humidity")
+NO_HUMIDITY_READING = -100
+
+RECORD_V1 = struct.Struct(f"<Id{len(SAMPLE_FIELDS)}f")
+
+
+class Sample(NamedTuple):
+    seq: Optional[int]
+    timestamp: Optional[float]
+    values: Sequence[float]  # In the SAMPLE_FIELDS order.
+
+
+def encode_hello(formats: Sequence[str] = FORMATS) -> bytes:
+    return f"{HELLO};{','.join(formats)}".encode()
+
+
+def decode_hello(payload) -> Optional[List[str]]:
+    # Offered formats, None if the payload isn't a HELLO message.
+    if bytes(payload[:len(HELLO) + 1]) != f"{HELLO};".encode():
+        return None
+    return str(payload[len(HELLO) + 1:], "utf-8").split(",")
+
+
+def encode_control(seq: int, message: str) -> bytes:
+    return f"{LIGHT};{seq};{message}".encode()
+
+
+def decode_control(payload) -> Tuple[int, List[str]]:
+    kind, seq, *values = str(payload, "utf-8").split(";")
+    if kind != LIGHT:
+        raise ValueError(f"Unknown control message: {kind}.")
+    return int(seq), values
+
+
+def encode_ack(seq: int) -> bytes:
+    return KIND_ACK + str(seq).encode()
+
+
+def choose_format(offered: Sequence[str]) -> str:
+    for format_ in offered:
+        if format_ in FORMATS:
+            return format_
+    return TEXT
+
+
+def encode_sample(sample: Sample, format_: str) -> bytes:
+    if format_ == BINARY_V1:
+        return RECORD_V1.pack(sample.seq, sample.timestamp, *sample.values)
+    return (";".join(str(value) for value in sample.values) + "\n").encode()
+
+
+def encode_batch(samples: Sequence[Sample], format_: str) -> bytes:
+    return b"".join(encode_sample(sample, format_) for sample in samples)
+
+
+def decode_batch(payload, format_: str) -> List[Sample]:
+    if format_ == BINARY_V1:
+        return [Sample(seq, timestamp, values) for seq, timestamp, *values in RECORD_V1.iter_unpack(payload)]
+    return [Sample(None, None, [float(value) for value in line.split(";")])
+            for line in str(payload, "utf-8").splitlines() if line]
@@ -2,8 +2,8 @@ import socket
 import yaml
 import time
 from queue import Queue
-from chamber.modules import sensors
-from threading import Thread
+from chamber.modules import sensors, telemetry
+from threading import Thread, Lock
 
 # todo: Wrap this whole program into a class to avoid global variables.
 
@@ -19,102 +19,163 @@ def measurement_dummy(q):
     q.put(sum_ / num)
 
 
+def send_frame(sc, payload):
+    sc.sendall(f'{len(payload):<{HEADER_SIZE}}'.encode() + payload)
+
+
+def receive_frame(sc):
+    return receive_exactly(sc, int(receive_exactly(sc, HEADER_SIZE)), started=True)
+
+
+def receive_exactly(sc, size, started=False):
+    data = bytearray()
+    while len(data) < size:
+        try:
+            chunk = sc.recv(size - len(data))
+        except socket.timeout:
+            if data or started:
+                continue
+            raise
+        if not chunk:
+            raise ConnectionResetError("Server closed the connection.")
+        data += chunk
+    return bytes(data)
+
+
+def send_batch(sc, batch, sample_format, push, send_lock):
+    if push:
+        with send_lock:
+            send_frame(sc, telemetry.KIND_SAMPLES + telemetry.encode_batch(batch, sample_format))
+    else:
+        send_frame(sc, telemetry.encode_batch(batch, sample_format))
+        response = receive_frame(sc).decode("utf-8")
+        response_components = response.split(";")
+        if response_components[0] != "default":
+            # Adjust lighting
+            print("adjusting lighting", response_components)
+
+
+def receive_controls(sc, send_lock):
+    # Acknowledges the light setpoints pushed by the server.
+    try:
+        while True:
+            try:
+                control = receive_frame(sc)
+            except socket.timeout:
+                continue
+            seq, values = telemetry.decode_control(control)
+            print("adjusting lighting", values)
+            with send_lock:
+                send_frame(sc, telemetry.encode_ack(seq))
+    except (OSError, ValueError):
+        try:
+            sc.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
 HEADER_SIZE = 10
+SAMPLE_RATE_HZ = 5
+FORMATS = telemetry.FORMATS + (telemetry.PUSH,)  # (telemetry.TEXT,) to test the text fallback.
+RECONNECT_DELAY_MIN = 0.5
+RECONNECT_DELAY_MAX = 5
 
 with open("../config/chamber_config.yaml", "r") as file:
     config = yaml.load(file, Loader=yaml.FullLoader)
 
 address = config["IP"]
 port = config["PORT"]
+socket_path = config.get("SOCKET_PATH")
+batch_size = max(1, int(config.get("BATCH_SIZE", 1)))
+batch_window = float(config.get("BATCH_WINDOW_S", 0.))
 
-measurement_index = 0
-means = [0, 0, 0]
-saturation_measurement_scheduled = False
 last_measurement_timestamp = time.time()
 current_timestamp = time.time()
 saturation_queue = Queue()
+reconnect_delay = RECONNECT_DELAY_MIN
 
 while True:
 
-    while True:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sc:
-
+    try:
+        if socket_path:
+            sc = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
             sc.settimeout(10)
             try:
-                sc.connect((address, port))
-            except socket.timeout:
-                print("Connection timed out.")
-                break
-            except ConnectionRefusedError:
-
-                print("Connection refused, reconnection attempt in 5s.")
-                measurement_index = 0
-                means = [0, 0, 0]
-                saturation_measurement_scheduled = False
-                time.sleep(5)
-                break
+                sc.connect(socket_path)
             except OSError:
-                print("Network unreachable, reconnecting in 5s.")
-                measurement_index = 0
-                means = [0, 0, 0]
-                saturation_measurement_scheduled = False
-                time.sleep(5)
-                break
-
-            current_timestamp = time.time()
+                sc.close()
+                raise
+        else:
+            sc = socket.create_connection((address, port), timeout=10)
+            sc.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError as err:
+        print(f"Connection failed ({err}), reconnecting in {reconnect_delay:.1f}s.")
+        time.sleep(reconnect_delay)
+        reconnect_delay = min(2 * reconnect_delay, RECONNECT_DELAY_MAX)
+        continue
+
+    # One connection per run, samples are streamed over it until it breaks.
+    reconnect_delay = RECONNECT_DELAY_MIN
+    measurement_index = 0
+    means = [0, 0, 0]
+    next_sample = time.monotonic()
+
+    with sc:
+        try:
+            send_frame(sc, telemetry.encode_hello(FORMATS))
+            accepted = telemetry.decode_hello(receive_frame(sc))
+            sample_format = accepted[0] if accepted else telemetry.TEXT
+            samples_per_frame = batch_size if accepted else 1
+            push = bool(accepted) and telemetry.PUSH in accepted
+            print(f"Streaming samples as {sample_format}, up to {samples_per_frame} per frame.")
+            send_lock = Lock()
+            if push:
+                Thread(target=receive_controls, args=(sc, send_lock), daemon=True).start()
+            batch = []
+            batch_deadline = None
 
-            if current_timestamp - last_measurement_timestamp >= 0.01*60:
+            while True:
 
-                Thread(target=measurement_dummy, args=(saturation_queue,)).start()
-                last_measurement_timestamp = current_timestamp
+                current_timestamp = time.time()
 
-            accel_values = sensors.LIS3DHAccelerometer.fake_read()
-            temp = [means[ind] * measurement_index / (measurement_index + 1) + accel_values[ind] / (measurement_index + 1) for ind in range(3)]
-            measurement_index += 1
-            means = temp
-            sensor_values = accel_values + means
-            temperatures = [sensors.MCP9808Thermometer.fake_read() for _ in range(3)]
-            sensor_values += temperatures
+                if current_timestamp - last_measurement_timestamp >= 0.01*60:
 
-            if not saturation_queue.empty():
-                val = saturation_queue.get()
-                sensor_values += [val]
-                saturation_queue.task_done()
+                    Thread(target=measurement_dummy, args=(saturation_queue,)).start()
+                    last_measurement_timestamp = current_timestamp
 
-            else:
-                sensor_values += [-100]
+                accel_values = sensors.LIS3DHAccelerometer.fake_read()
+                temp = [means[ind] * measurement_index / (measurement_index + 1) + accel_values[ind] / (measurement_index + 1) for ind in range(3)]
+                means = temp
+                sensor_values = accel_values + means
+                temperatures = [sensors.MCP9808Thermometer.fake_read() for _ in range(3)]
+                sensor_values += temperatures
 
-            msg = ";".join([str(val) for val in sensor_values]) + "\n"
-            msg = f'{len(msg):<{HEADER_SIZE}}' + msg
+                if not saturation_queue.empty():
+                    val = saturation_queue.get()
+                    sensor_values += [val]
+                    saturation_queue.task_done()
 
-            fresh = True
-            try:
-                sc.sendall(msg.encode())
-            except BrokenPipeError:
-                measurement_index = 0
-                means = [0, 0, 0]
-                saturation_measurement_scheduled = False
-                break
+                else:
+                    sensor_values += [telemetry.NO_HUMIDITY_READING]
 
-            response = ""
+                sample = telemetry.Sample(measurement_index, time.time(), sensor_values)
+                measurement_index += 1
 
-            while True:
-                data = sc.recv(HEADER_SIZE)
-                data = data.decode('utf-8')
+                if not batch:
+                    batch_deadline = time.monotonic() + batch_window if batch_window > 0 else None  # 0 - no limit.
+                batch.append(sample)
 
-                if fresh:
-                    expected_response_size = int(data[:HEADER_SIZE])
-                    fresh = False
-                    response += data[HEADER_SIZE:]
-                else:
-                    response += data
+                if len(batch) >= samples_per_frame or batch_deadline is not None and time.monotonic() >= batch_deadline:
+                    send_batch(sc, batch, sample_format, push, send_lock)
+                    batch = []
 
-                if len(response) == expected_response_size:
-                    break
-            response_components = response.split(";")
-            if response_components[0] != "default":
-                # Adjust lighting
-                # print("adjusting lighting", int(response_components[0]), int(response_components[1]))
-                pass
+                next_sample += 1. / SAMPLE_RATE_HZ
+                if batch and batch_deadline is not None and batch_deadline < next_sample:
+                    # The window runs out before the next sample, the partial batch is sent on time.
+                    time.sleep(max(0., batch_deadline - time.monotonic()))
+                    send_batch(sc, batch, sample_format, push, send_lock)
+                    batch = []
+                time.sleep(max(0., next_sample - time.monotonic()))
 
-            time.sleep(0.2)
+        except (OSError, ValueError) as err:
+            print(f"Connection lost ({err}).")
@@ -25,4 +25,11 @@ namespace Commands{
         constexpr uint8_t STOPPING_MODE_REPORT = 0x07;
         constexpr uint8_t IDLE_MODE_REPORT = 0x08;
     }
-}
+    namespace Framing{
+
+        // START_OF_FRAME | LENGTH | OPCODE | PAYLOAD | CRC8, see modules/backend/clinostat_protocol.py.
+        constexpr uint8_t START_OF_FRAME = 0xA5;
+        constexpr uint8_t MAX_FRAME_LENGTH = 16;
+        constexpr uint8_t CRC_POLYNOMIAL = 0x07;
+    }
+}
\ No newline at end of file
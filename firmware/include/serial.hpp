@@ -17,4 +17,8 @@ class Serial{
     uint8_t read();
     bool available();
     void flush();
+    bool readFrame(uint8_t* frame, uint8_t& length);
+    void respond(const uint8_t& byte);
+
+    bool framed = false; // Set once a valid frame is received, responses are then framed as well.
 };
\ No newline at end of file
@@ -178,7 +178,7 @@ void updateProgramStatus(States::Driver&& new_mode){
                 
                 if(device_connected){
                     
-                    serial.write(Commands::Transmit::STEPPERS_STOPPED);
+                    serial.respond(Commands::Transmit::STEPPERS_STOPPED);
                 }
                 current_program_status = States::Driver::IDLE;
             } 
@@ -195,7 +195,7 @@ void updateProgramStatus(States::Driver&& new_mode){
                 previous_program_status = current_program_status;
                 current_program_status = States::Driver::RUNNING;
                 runSteppers(speed_buffer[0].float_value,speed_buffer[1].float_value);
-                serial.write(Commands::Transmit::STEPPERS_STARTING);
+                serial.respond(Commands::Transmit::STEPPERS_STARTING);
             } 
             // else do nothig.
 
@@ -208,7 +208,7 @@ void updateProgramStatus(States::Driver&& new_mode){
                 previous_program_status = current_program_status;
                 current_program_status = States::Driver::SOFT_STOPPING;
                 stopSteppers();
-                serial.write(Commands::Transmit::STOPPING_STEPPERS);
+                serial.respond(Commands::Transmit::STOPPING_STEPPERS);
             } 
             // else do nothig.
 
@@ -222,17 +222,17 @@ void updateProgramStatus(States::Driver&& new_mode){
                 previous_program_status = current_program_status;
                 current_program_status = States::Driver::SOFT_STOPPING;
                 stopSteppers();
-                serial.write(Commands::Transmit::STOPPING_STEPPERS);
+                serial.respond(Commands::Transmit::STOPPING_STEPPERS);
 
             } 
 
         break;
 
         case States::Driver::ABORT: // Aborting the current run of the clinostat. Used to completely deenergize motors after
-        // soft stop or to immediately stop the clinostat in the case of emergency.
+        // soft stop or to immediately stop the clinostat in the case of emergency. Cuts a soft stop in progress short.
 
 
-            if(current_program_status == States::Driver::RUNNING){
+            if(current_program_status == States::Driver::RUNNING || current_program_status == States::Driver::SOFT_STOPPING){
                 
                 previous_program_status = current_program_status;
                 current_program_status = States::Driver::ABORT;
@@ -268,10 +268,26 @@ void handleSerial(){
     */
 
     uint8_t command = serial.read(); // Read 1 byte.
+    uint8_t frame[Commands::Framing::MAX_FRAME_LENGTH];
+    uint8_t frame_length = 0;
+    uint8_t payload_index = 1;
+
+    if(command == Commands::Framing::START_OF_FRAME){
+
+        if(!serial.readFrame(frame, frame_length)) return; // Corrupted frame, wait for the next one.
+
+        command = frame[0];
+        uint8_t payload_size = command == Commands::Receive::RUN_COMMAND ? 8 :
+                               command == Commands::Receive::BEGIN_WATERING_COMMAND ? 4 : 0;
+        if(frame_length != payload_size + 1) return;
+
+        serial.framed = true;
+    }
+    else if(serial.framed) return; // Bytes outside of a frame are line noise once the link is framed.
 
     if(command == Commands::Receive::CONNECT_COMMAND){
 
-        serial.write(Commands::Transmit::CLINOSTAT_CONNECTED);
+        serial.respond(Commands::Transmit::CLINOSTAT_CONNECTED);
         device_connected = true;
     }
 
@@ -279,6 +295,7 @@ void handleSerial(){
 
         updateProgramStatus(States::Driver::ABORT);
         device_connected = false;
+        serial.framed = false;
         if(pumping){
 
             TURN_OFF_PUMP;
@@ -296,7 +313,7 @@ void handleSerial(){
                 
                 for(uint8_t j=0;j<4;j++){
 
-                    uint8_t temp = serial.read();
+                    uint8_t temp = serial.framed ? frame[payload_index++] : serial.read();
                     speed_buffer[i].byte_value[j] = temp;
 
                     }
@@ -307,7 +324,7 @@ void handleSerial(){
 
                 for(uint8_t j=0;j<4;j++){
 
-                    uint8_t temp = serial.read();
+                    uint8_t temp = serial.framed ? frame[payload_index++] : serial.read();
                     watering_volume.byte_value[j] = temp;
 
                     }
@@ -353,15 +370,15 @@ void handleSerial(){
                     switch(current_program_status){
 
                         case States::Driver::IDLE:
-                            serial.write(Commands::Transmit::IDLE_MODE_REPORT);
+                            serial.respond(Commands::Transmit::IDLE_MODE_REPORT);
                         break;
 
                         case States::Driver::RUNNING:
-                            serial.write(Commands::Transmit::RUNNING_MODE_REPORT);
+                            serial.respond(Commands::Transmit::RUNNING_MODE_REPORT);
                         break;
 
                         case States::Driver::SOFT_STOPPING:
-                            serial.write(Commands::Transmit::STOPPING_MODE_REPORT);
+                            serial.respond(Commands::Transmit::STOPPING_MODE_REPORT);
                         break;
 
                         default:
@@ -374,12 +391,12 @@ void handleSerial(){
 
                     if(pumping){
 
-                        serial.write(Commands::Transmit::STILL_WATERING);
+                        serial.respond(Commands::Transmit::STILL_WATERING);
 
                     }
 
                     else{
-                        serial.write(Commands::Transmit::WATERING_STARTED);
+                        serial.respond(Commands::Transmit::WATERING_STARTED);
                         TURN_ON_PUMP;
                         pump_start_timestamp = program_time_milis;
                         pumping = true;
@@ -1,5 +1,16 @@
 #include "headers.hpp"
 #include "serial.hpp"
+#include "commands.hpp"
+
+static uint8_t crc8(uint8_t crc, const uint8_t& byte){
+
+    crc ^= byte;
+    for(uint8_t i=0;i<8;i++){
+
+        crc = (crc & 0x80) ? (crc << 1) ^ Commands::Framing::CRC_POLYNOMIAL : (crc << 1);
+    }
+    return crc;
+}
 
 Serial::Serial(){
 
@@ -61,4 +72,39 @@ void Serial::flush(){
     uint8_t temp;
     while(UCSR1A & (1 << RXC1)) temp = UDR1;
 
-}
\ No newline at end of file
+}
+
+bool Serial::readFrame(uint8_t* frame, uint8_t& length){
+
+    // Called after the start of frame byte has been read. Reads the opcode and payload into frame, returns false
+    // if the frame is invalid - the caller drops it and waits for the next start of frame.
+
+    length = read();
+    if(length == 0 || length > Commands::Framing::MAX_FRAME_LENGTH) return false;
+
+    uint8_t crc = crc8(0, length);
+    for(uint8_t i=0;i<length;i++){
+
+        frame[i] = read();
+        crc = crc8(crc, frame[i]);
+    }
+
+    return read() == crc;
+
+}
+
+void Serial::respond(const uint8_t& byte){
+
+    if(framed){
+
+        write(Commands::Framing::START_OF_FRAME);
+        write(1);
+        write(byte);
+        write(crc8(crc8(0, 1), byte));
+    }
+    else{
+
+        write(byte);
+    }
+
+}
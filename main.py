@@ -6,5 +6,5 @@ if __name__ == "__main__":
     root.resizable(False, False)
     root.title("Clinostat control system")
     root.iconphoto(True, PhotoImage(file="icon/favicon.gif"))
-    root.after(1, root.program_loop)
+    root.after_idle(root.program_loop)
     root.mainloop()
@@ -1,10 +1,188 @@
 import serial
-import time
 import serial.serialutil
 from serial.tools import list_ports
-import struct
-from time import sleep
-from typing import Tuple
+import enum
+import functools
+import os
+import threading
+import time
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, Optional, Callable, List
+from modules.backend import clinostat_protocol
+from modules.backend.serial_metrics import SerialMetrics
+
+
+class ControllerEvent(enum.Enum):
+
+    # Bytes the controller sends, either as a response to a command or on its own.
+
+    CONNECTED = b'\x01'
+    TOP_SPEED = b'\x02'
+    STARTING = b'\x03'
+    STOPPING = b'\x04'
+    STOPPED = b'\x05'
+    RUNNING_STATE = b'\x06'
+    STOPPING_STATE = b'\x07'
+    IDLE_STATE = b'\x08'
+    PUMPING_STARTED = b'\x09'
+    STILL_PUMPING = b'\x0a'
+
+    @classmethod
+    def decode(cls, byte: int) -> Optional["ControllerEvent"]:
+        try:
+            return cls(bytes((byte,)))
+        except ValueError:
+            return None
+
+
+class _EventWaiter:
+
+    def __init__(self, events: tuple):
+        self.events = events
+        self.event = None
+        self.error = None
+        self.interrupted = False
+        self._done = threading.Event()
+
+    def resolve(self, event: ControllerEvent) -> None:
+        self.event = event
+        self._done.set()
+
+    def fail(self, error: Exception) -> None:
+        self.error = error
+        self._done.set()
+
+    def interrupt(self) -> None:
+        self.interrupted = True
+        self._done.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._done.wait(timeout)
+
+
+class ControllerEventBus:
+
+    # Demultiplexes the controller events decoded by the reader thread. An event goes to the oldest command
+    # waiting for it, events nobody is waiting for (unsolicited ones) are passed to the subscribers.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = []
+        self._subscribers = []
+        self._observers = []
+        self._error = None
+
+    def observe(self, callback: Callable) -> None:
+        # Observers see every event before it is dispatched, solicited or not.
+        with self._lock:
+            self._observers.append(callback)
+
+    def unobserve(self, callback: Callable) -> None:
+        with self._lock:
+            self._observers = [observer for observer in self._observers if observer != callback]
+
+    def subscribe(self, callback: Callable, *events: ControllerEvent) -> None:
+        with self._lock:
+            self._subscribers.append((callback, events))
+
+    def unsubscribe(self, callback: Callable) -> None:
+        with self._lock:
+            self._subscribers = [sub for sub in self._subscribers if sub[0] != callback]
+
+    def expect(self, *events: ControllerEvent) -> _EventWaiter:
+        # Has to be called before the command is sent, so a fast response can't slip past the waiter.
+        waiter = _EventWaiter(events)
+        with self._lock:
+            if self._error:
+                waiter.fail(self._error)
+            else:
+                self._waiters.append(waiter)
+        return waiter
+
+    def cancel(self, waiter: _EventWaiter) -> None:
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def publish(self, event: ControllerEvent) -> None:
+        with self._lock:
+            observers = list(self._observers)
+        for callback in observers:
+            callback(event)
+
+        with self._lock:
+            for waiter in self._waiters:
+                if event in waiter.events:
+                    self._waiters.remove(waiter)
+                    waiter.resolve(event)
+                    return
+            subscribers = [callback for callback, events in self._subscribers if not events or event in events]
+
+        for callback in subscribers:
+            callback(event)
+
+    def interrupt(self) -> None:
+        with self._lock:
+            waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            waiter.interrupt()
+
+    def fail(self, error: Exception) -> None:
+        with self._lock:
+            self._error = error
+            waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            waiter.fail(error)
+
+
+class ClinostatReader(threading.Thread):
+
+    def __init__(self, port: serial.Serial, bus: ControllerEventBus, decoder, **kwargs):
+        super().__init__(daemon=True, **kwargs)
+        self._port = port
+        self._bus = bus
+        self.decoder = decoder
+        self._running = True
+
+    def run(self) -> None:
+        while self._running:
+            try:
+                data = self._port.read(self._port.in_waiting or 1)
+            except (serial.SerialException, OSError, TypeError):
+                # TypeError is raised by pyserial when the port gets closed under a pending read.
+                if self._running:
+                    self._bus.fail(ClinostatCommunicationError("Device has been disconnected."))
+                return
+
+            for opcode, _ in self.decoder.feed(data):
+                event = ControllerEvent.decode(opcode)
+                if event is not None:
+                    self._bus.publish(event)
+
+    def stop(self) -> None:
+        self._running = False
+        try:
+            self._port.cancel_read()
+        except (AttributeError, serial.SerialException):
+            pass
+
+
+def _timed_command(method: Callable) -> Callable:
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.metrics.measure(method.__name__) as outcome:
+            try:
+                return method(self, *args, **kwargs)
+            except ClinostatTimeoutError:
+                outcome["result"] = "timeouts"
+                raise
+            except ClinostatCommandInterrupted:
+                outcome["result"] = "interrupted"
+                raise
+
+    return wrapper
 
 
 class Clinostat:
@@ -23,44 +201,63 @@ class Clinostat:
 
     # Commands received from device.
 
-    _CONNECTED = b'\x01'
-    _TOP_SPEED = b'\x02'
-    _STARTING = b'\x03'
-    _STOPPING = b'\x04'
-    _STOPPED = b'\x05'
-    _RUNNING_STATE = b'\x06'
-    _STOPPING_STATE = b'\x07'
-    _IDLE_STATE = b'\x08'
-    _PUMPING_STARTED = b'\x09'
-    _STILL_PUMPING = b'\x0a'
-
-    def __init__(self, port_name):
+    _CONNECTED = ControllerEvent.CONNECTED
+    _TOP_SPEED = ControllerEvent.TOP_SPEED
+    _STARTING = ControllerEvent.STARTING
+    _STOPPING = ControllerEvent.STOPPING
+    _STOPPED = ControllerEvent.STOPPED
+    _RUNNING_STATE = ControllerEvent.RUNNING_STATE
+    _STOPPING_STATE = ControllerEvent.STOPPING_STATE
+    _IDLE_STATE = ControllerEvent.IDLE_STATE
+    _PUMPING_STARTED = ControllerEvent.PUMPING_STARTED
+    _STILL_PUMPING = ControllerEvent.STILL_PUMPING
+
+    # Responses a command waits for.
+
+    _EXPECTED_RESPONSES = {
+        _RUN: (_STARTING,),
+        _RESUME: (_STARTING,),
+        _PAUSE: (_STOPPING,),
+        _ECHO: (_RUNNING_STATE, _IDLE_STATE, _STOPPING_STATE),
+        _WATERING: (_PUMPING_STARTED, _STILL_PUMPING)
+    }
+
+    # Device state implied by the controller messages, cached for the UI and the heartbeat.
+
+    _STATES = {
+        _RUNNING_STATE: "running",
+        _STARTING: "running",
+        _STOPPING_STATE: "stopping",
+        _STOPPING: "stopping",
+        _IDLE_STATE: "idle",
+        _STOPPED: "idle"
+    }
+
+    RESPONSE_TIMEOUT = 2
+    STOP_TIMEOUT = 60  # Upper bound for ramping the motors down.
+
+    def __init__(self, port_name, metrics: Optional[SerialMetrics] = None, protocol: str = "raw"):
 
         self._baud = 57600
-        self._port = serial.Serial(port_name, self._baud, timeout=2)
+        self._port = _open_port(port_name, self._baud, timeout=2)
         self.port_name = port_name
         self.console = None
         self.res = False
-
+        self._interrupted = threading.Event()
+        self._write_lock = threading.Lock()
+        self.metrics = metrics if metrics is not None else SerialMetrics()
+        self.events = ControllerEventBus()
+        self.state = None
+        self.state_timestamp = 0.
+        self.events.observe(self._track_state)
+        self.protocol = protocol
+        self._codec = clinostat_protocol.CODECS[protocol]
+        self._reader = ClinostatReader(self._port, self.events, self._codec.decoder())
+        self._reader.start()
+
+    @_timed_command
     def echo(self) -> None:
-        try:
-            self._port.write(Clinostat._ECHO)
-        except serial.SerialException as err:
-            self.console.println("Device cannot be reached. Check USB cable and update serial ports.",
-                                 headline="SERIAL ERROR: ", msg_type="ERROR")
-            raise ClinostatCommunicationError("Device disconnected.")
-        sleep(0.1)
-
-        try:
-            response = self._port.read(1)
-
-        except serial.SerialTimeoutException:
-            self.console.println("Device did not respond.", headline="SERIAL ERROR: ", msg_type="ERROR")
-            raise ClinostatCommunicationError("Device didn't respond.")
-        except serial.SerialException:
-            self.console.println("Device cannot be reached. Check USB cable and update serial ports.",
-                                 headline="SERIAL ERROR: ", msg_type="ERROR")
-            raise ClinostatCommunicationError("Device has been disconnected.")
+        response = self._transact(Clinostat._ECHO)
 
         message = "Device is currently "
 
@@ -73,31 +270,12 @@ class Clinostat:
 
         self.console.println(message, headline="CONTROLLER: ", msg_type="CONTROLLER")
 
+    @_timed_command
     def run(self, rpm: Tuple[float, ...]):
         # Sends mode ID and 8 more bytes containing 2 floats for the speed.
         # listen for response, return true if controller responded correctly
         self.res = False
-        values = [r for r in rpm]
-        message = Clinostat._RUN
-        for speed in values[:2]:
-            message += bytes(bytearray(struct.pack("f", speed)))
-
-        # message = message[0:1] + message[:0:-1]
-
-        for byte in message:
-            try:
-                self._port.write(byte.to_bytes(1, 'little'))
-            except serial.SerialException:
-                self.console.println("Device cannot be reached. Check USB cable and update serial ports.",
-                                     headline="SERIAL ERROR: ", msg_type="ERROR")
-                raise ClinostatCommunicationError("Serial exception error.")
-            sleep(0.1)
-        try:
-            response = self._port.read(1)
-        except serial.SerialTimeoutException:
-            raise ClinostatCommunicationError("Device didn't respond.")
-        except serial.SerialException:
-            raise ClinostatCommunicationError("Device has been disconnected.")
+        response = self._transact(Clinostat._RUN, *rpm[:2])
         if response == Clinostat._STARTING:
             self.console.println("Starting motors.", headline="CONTROLLER: ", msg_type="CONTROLLER")
 
@@ -111,42 +289,69 @@ class Clinostat:
         # listen for response, return true if controller responded correctly
         pass
 
+    @_timed_command
     def abort(self):  # Mode byte: b'\x03'.
 
-        self.handle_command(Clinostat._ABORT, response=False)
-        if not self.res:
-            rcv = b''
-            while rcv != Clinostat._STOPPED:
-                rcv = self._port.read(1)
+        self._interrupted.clear()
+        if self.res or self.state == "idle":  # Motors already stopped, abort only de-energizes them.
+            self._send_command(Clinostat._ABORT)
+        else:
+            stopped = self.events.expect(Clinostat._STOPPED)
+            self._send_command(Clinostat._ABORT, waiter=stopped)
+            self._await(stopped, Clinostat.STOP_TIMEOUT)
             self.console.println("Motors have stopped.", headline="CONTROLLER: ", msg_type="CONTROLLER")
             self.res = False
 
+    @_timed_command
     def pause(self):  # Mode byte: b'\x04'.
 
-        self.handle_command(Clinostat._PAUSE, response=False)
-        rcv = b''
-        while rcv != Clinostat._STOPPED:
-            try:
-                rcv = self._port.read(1)
-            except serial.SerialException:
-                self.console.println("Device cannot be reached. Check USB cable and update serial ports.",
-                                     headline="CONTROLLER: ", msg_type="ERROR")
-                raise ClinostatCommunicationError("Device disconnected.")
+        # Both waiters are registered up front, the motors may stop before the first response is handled.
+        stopped = self.events.expect(Clinostat._STOPPED)
+        try:
+            self._transact(Clinostat._PAUSE)
+        except (ClinostatCommunicationError, ClinostatCommandInterrupted):
+            self.events.cancel(stopped)
+            raise
+        self._await(stopped, Clinostat.STOP_TIMEOUT)
 
         self.console.println("Motors have stopped.", headline="CONTROLLER: ", msg_type="CONTROLLER")
         self.res = True
 
+    @_timed_command
     def resume(self):  # Mode byte: b'\x05'.
         # resume run with previously set speeds, check for flag if paused first.
         # listen for response, return true if controller responded correctly
         self.handle_command(Clinostat._RESUME)
         self.res = False
 
+    def ping(self, timeout: float = RESPONSE_TIMEOUT) -> Optional[ControllerEvent]:
+        # Silent echo used by the heartbeat. Only the write lock is taken, the response is awaited on the event bus.
+        # Returns None if the controller didn't answer in time.
+        waiter = self.events.expect(*Clinostat._EXPECTED_RESPONSES[Clinostat._ECHO])
+        try:
+            with self._write_lock:
+                self._port.write(Clinostat.encode_command(Clinostat._ECHO, protocol=self.protocol))
+        except serial.SerialException:
+            self.events.cancel(waiter)
+            raise ClinostatCommunicationError("Device out of reach.")
+
+        if not waiter.wait(timeout):
+            self.events.cancel(waiter)
+            return None
+        if waiter.error is not None:
+            raise ClinostatCommunicationError(waiter.error.message)
+        return waiter.event
+
+    def state_age(self) -> float:
+        return time.monotonic() - self.state_timestamp
+
     def disconnect(self):
 
-        self._port.write(Clinostat._DISCONNECT)
+        with self._write_lock:
+            self._port.write(Clinostat.encode_command(Clinostat._DISCONNECT, protocol=self.protocol))
 
     def close_serial(self):
+        self._reader.stop()
         try:
             self.disconnect()
         except serial.serialutil.SerialException:
@@ -156,47 +361,32 @@ class Clinostat:
                 self._port.close()
             except serial.SerialException:
                 pass
+            self.events.fail(ClinostatCommunicationError("Serial port closed."))
 
     def link_console(self, console) -> None:
+        if self.console is None:
+            self.events.subscribe(self._report_event)
         self.console = console
 
+    def interrupt(self) -> None:
+        # Called from outside the thread currently talking to the device, when an urgent command (abort) has to
+        # preempt a command that is still waiting for the controller.
+        self._interrupted.set()
+        self.events.interrupt()
+
     def handle_command(self, command, response=True):
 
-        try:
-            self._port.write(command)
-        except serial.SerialException as err:
-            self.console.println("Device cannot be reached. Check USB cable and update serial ports.",
-                                 headline="SERIAL ERROR: ", msg_type="ERROR")
-            raise ClinostatCommunicationError("Device out of reach.")
-        sleep(0.1)
         if response:
-            try:
-                response = self._port.read(1)
-                print(response)
-            except serial.SerialTimeoutException:
-                raise ClinostatCommunicationError("Device didn't respond.")
+            response = self._transact(command)
             msg = self._generate_message(response)
             self.console.println(msg, headline="CONTROLLER: ", msg_type="CONTROLLER")
+        else:
+            self._send_command(command)
 
+    @_timed_command
     def dump_water(self, amount):
 
-        message = Clinostat._WATERING
-        message += bytes(bytearray(struct.pack("f", amount)))
-
-        for byte in message:
-            try:
-                self._port.write(byte.to_bytes(1, 'little'))
-            except serial.serialutil.PortNotOpenError:
-                raise ClinostatCommunicationError("")
-            except serial.SerialException as err:
-                self.console.println(err.args[0], headline="SERIAL ERROR: ", msg_type="ERROR")
-                raise ClinostatCommunicationError
-            sleep(0.1)
-        try:
-            response = self._port.read(1)
-            print(response)
-        except serial.SerialTimeoutException:
-            raise ClinostatCommunicationError("Device didn't respond.")
+        response = self._transact(Clinostat._WATERING, amount)
         if response == Clinostat._PUMPING_STARTED:
             self.console.println("Watering starting.", headline="CONTROLLER: ", msg_type="CONTROLLER")
         elif response == Clinostat._STILL_PUMPING:
@@ -208,6 +398,63 @@ class Clinostat:
             raise ClinostatCommunicationError("Incorrect response.")
             # todo: Actually add handling the mentioned abort.
 
+    @staticmethod
+    def encode_command(command: bytes, *values: float, protocol: str = "raw") -> bytes:
+        # Builds the whole packet (command byte + packed payload) so it can be sent with a single write.
+        return clinostat_protocol.CODECS[protocol].encode(command[0], *values)
+
+    def _send_command(self, command: bytes, *values: float, waiter: Optional[_EventWaiter] = None) -> None:
+        # The firmware busy-reads the payload bytes right after the command byte, so the packet is written in one go
+        # and flushed to the UART instead of being paced byte by byte.
+        try:
+            with self._write_lock, self.metrics.phase("write"):
+                self._port.write(Clinostat.encode_command(command, *values, protocol=self.protocol))
+                self._port.flush()
+        except serial.SerialException:
+            if waiter is not None:
+                self.events.cancel(waiter)
+            self.console.println("Device cannot be reached. Check USB cable and update serial ports.",
+                                 headline="SERIAL ERROR: ", msg_type="ERROR")
+            raise ClinostatCommunicationError("Device out of reach.")
+
+    def _transact(self, command: bytes, *values: float) -> ControllerEvent:
+        waiter = self.events.expect(*Clinostat._EXPECTED_RESPONSES[command])
+        self._send_command(command, *values, waiter=waiter)
+        return self._await(waiter, Clinostat.RESPONSE_TIMEOUT)
+
+    def _await(self, waiter: _EventWaiter, timeout: float) -> ControllerEvent:
+        if not self._interrupted.is_set():
+            with self.metrics.phase("response"):
+                waiter.wait(timeout)
+
+        if waiter.interrupted or self._interrupted.is_set():
+            self.events.cancel(waiter)
+            raise ClinostatCommandInterrupted("Waiting for response interrupted.")
+
+        if waiter.error is not None:
+            self.console.println("Device cannot be reached. Check USB cable and update serial ports.",
+                                 headline="SERIAL ERROR: ", msg_type="ERROR")
+            raise ClinostatCommunicationError(waiter.error.message)
+
+        if waiter.event is None:
+            self.events.cancel(waiter)
+            self.console.println("Device did not respond.", headline="SERIAL ERROR: ", msg_type="ERROR")
+            raise ClinostatTimeoutError("Device didn't respond.")
+
+        return waiter.event
+
+    def _track_state(self, event: ControllerEvent) -> None:
+        state = Clinostat._STATES.get(event)
+        if state is not None:
+            self.state = state
+            self.state_timestamp = time.monotonic()
+
+    def _report_event(self, event: ControllerEvent) -> None:
+        # Unsolicited controller messages, e.g. top speed reached or the motors stopping after a command timed out.
+        if event in (Clinostat._RUNNING_STATE, Clinostat._IDLE_STATE, Clinostat._STOPPING_STATE):
+            return  # Late answer to a heartbeat that has already timed out.
+        self.console.println(self._generate_message(event), headline="CONTROLLER: ", msg_type="CONTROLLER")
+
     @staticmethod
     def _generate_message(response):
 
@@ -229,19 +476,32 @@ class Clinostat:
         return message
 
     @staticmethod
-    def try_connection(port):
+    def try_connection(port, timeout=2, protocol: str = "raw"):
+        codec = clinostat_protocol.CODECS[protocol]
         try:
-            test_serial = serial.Serial(port, baudrate=57600, timeout=2)
-        except serial.serialutil.SerialException:
+            test_serial = _open_port(port, 57600, timeout=timeout)
+        except (serial.serialutil.SerialException, OSError):
             return False
-        test_serial.write(Clinostat._CONNECT)
-        time.sleep(0.001)
-        received = test_serial.read(1)
-        test_serial.close()
-        if received == Clinostat._CONNECTED:
-            return True
-        else:
+        try:
+            test_serial.write(Clinostat.encode_command(Clinostat._CONNECT, protocol=protocol))
+            received = test_serial.read(len(codec.encode(Clinostat._CONNECTED.value[0], layouts={})))
+        except serial.serialutil.SerialException:
             return False
+        finally:
+            test_serial.close()
+        return any(opcode == Clinostat._CONNECTED.value[0] for opcode, _ in codec.decoder().feed(received))
+
+
+def _open_port(port_name: str, baud: int, timeout: float) -> serial.Serial:
+    # DTR is kept low while opening, adapters wired to the reset line would otherwise reboot the controller
+    # on every open and the handshake would have to wait for it to boot.
+    port = serial.Serial()
+    port.port = port_name
+    port.baudrate = baud
+    port.timeout = timeout
+    port.dtr = False
+    port.open()
+    return port
 
 
 def get_ports() -> list:
@@ -249,7 +509,94 @@ def get_ports() -> list:
     return [str(port).split(" ")[0] for port in serial.tools.list_ports.comports()]
 
 
+class PortDiscovery:
+
+    # Probes serial ports for a clinostat in parallel and remembers where the last one was found.
+
+    HANDSHAKE_TIMEOUT = 0.5
+    MAX_WORKERS = 8
+
+    def __init__(self, cache_path: Optional[str] = None, timeout: float = HANDSHAKE_TIMEOUT, protocol: str = "raw"):
+        self.cache_path = cache_path
+        self.timeout = timeout
+        self.protocol = protocol
+        self._last_device = self._load_cache()
+
+    def candidates(self, exclude: Tuple[str, ...] = ()) -> List[str]:
+        # Available ports, with the one the clinostat was last seen on first. The serial number is checked
+        # as well, USB devices are not guaranteed to get the same port name after being replugged.
+        ports = [port for port in serial.tools.list_ports.comports() if port.device not in exclude]
+        last_port = self._last_device.get("port")
+        last_serial = self._last_device.get("serial_number")
+
+        def rank(port):
+            if last_serial and port.serial_number == last_serial:
+                return 0
+            if port.device == last_port:
+                return 1
+            return 2
+
+        return [port.device for port in sorted(ports, key=rank)]
+
+    def probe(self, ports: Optional[List[str]] = None) -> List[str]:
+        if ports is None:
+            ports = self.candidates()
+        if not ports:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(len(ports), PortDiscovery.MAX_WORKERS)) as executor:
+            results = executor.map(lambda port: Clinostat.try_connection(port, timeout=self.timeout,
+                                                                            protocol=self.protocol), ports)
+            return [port for port, found in zip(ports, results) if found]
+
+    def find_device(self, exclude: Tuple[str, ...] = ()) -> Optional[str]:
+        ports = self.candidates(exclude)
+        if not ports:
+            return None
+
+        if self._last_device and Clinostat.try_connection(ports[0], timeout=self.timeout, protocol=self.protocol):
+            return ports[0]
+
+        found = self.probe(ports[1:] if self._last_device else ports)
+        return found[0] if found else None
+
+    def remember(self, port_name: str) -> None:
+        serial_number = None
+        for port in serial.tools.list_ports.comports():
+            if port.device == port_name:
+                serial_number = port.serial_number
+                break
+        self._last_device = {"port": port_name, "serial_number": serial_number}
+
+        if self.cache_path:
+            try:
+                with open(self.cache_path, "w") as file:
+                    yaml.dump(self._last_device, file)
+            except OSError:
+                pass
+
+    def _load_cache(self) -> dict:
+        if not self.cache_path or not os.path.isfile(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path, "r") as file:
+                cached = yaml.load(file, Loader=yaml.FullLoader)
+        except (OSError, yaml.YAMLError):
+            return {}
+        return cached if isinstance(cached, dict) else {}
+
+
 class ClinostatCommunicationError(Exception):
     def __init__(self, message="Clinostat backend error."):
         self.message = message
         super().__init__()
+
+
+class ClinostatTimeoutError(ClinostatCommunicationError):
+    pass
+
+
+class ClinostatCommandInterrupted(Exception):
+    def __init__(self, message="Command interrupted by a more urgent one."):
+        self.message = message
+        super().__init__()
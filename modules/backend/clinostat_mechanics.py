@@ -0,0 +1,46 @@
+import math
+
+# Timing of the stepper driver of the firmware, firmware/src/clinostat-stepper-driver.cpp. Used by the simulator
+# and to predict how long the motors take to ramp up or down.
+
+# firmware/include/driver_config.hpp, clinostat_mechanics.hpp, headers.hpp
+
+F_CPU = 16000000
+TIMER_PRESCALER = 64
+STOP_INTERVAL = 10000
+STEPS_PER_REVOLUTION = 400 * 16
+GEARBOX_REDUCTION = 4
+WHEEL_RATIO = 86 // 28  # Integer division, as in the firmware.
+
+TIMER_TICK_S = TIMER_PRESCALER / F_CPU
+
+
+def rpm_to_timer_interval(speed: float) -> int:
+    # Same integer/float promotion order as rpmToTimerInterval in the firmware.
+    if speed <= 0:
+        return STOP_INTERVAL
+    return int(F_CPU // TIMER_PRESCALER // STEPS_PER_REVOLUTION * 60 / (speed * GEARBOX_REDUCTION * WHEEL_RATIO))
+
+
+def ramp_steps(top_interval: int) -> int:
+    # First step n for which STOP_INTERVAL*(sqrt(n+1) - sqrt(n)) <= top_interval, i.e. the ISR stops accelerating.
+    if top_interval >= STOP_INTERVAL:
+        return 1
+    n = max(1, int((STOP_INTERVAL / (2 * top_interval)) ** 2) - 2)
+    while STOP_INTERVAL * (math.sqrt(n + 1) - math.sqrt(n)) > top_interval:
+        n += 1
+    return n
+
+
+def ramp_duration(steps: float) -> float:
+    # The intervals of the ramp telescope to STOP_INTERVAL*(sqrt(n+1) - 1) timer ticks.
+    return STOP_INTERVAL * (math.sqrt(steps + 1) - 1) * TIMER_TICK_S
+
+
+def steps_after(duration: float) -> float:
+    return (duration / (STOP_INTERVAL * TIMER_TICK_S) + 1) ** 2 - 1
+
+
+def ramp_time(rpm: float) -> float:
+    # Ramp between standstill and the given speed, s. The ramp up and the ramp down take the same time.
+    return ramp_duration(ramp_steps(rpm_to_timer_interval(rpm))) if rpm > 0 else 0.
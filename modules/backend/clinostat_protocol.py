@@ -0,0 +1,167 @@
+import struct
+from typing import Dict, List, Tuple
+
+# Wire format of the host <-> controller link, shared by Clinostat and the simulator (testing/clinostat_dummy.py).
+#
+# raw    - the original protocol: a command byte followed by its packed payload, responses are single bytes.
+# framed - START_OF_FRAME | LENGTH | OPCODE | PAYLOAD | CRC8, LENGTH counts the opcode and payload bytes and the
+#          CRC-8 (polynomial 0x07) covers LENGTH, OPCODE and PAYLOAD. The controller starts in raw mode, switches
+#          to framed responses on the first valid frame and ignores bytes outside of frames until disconnect.
+
+START_OF_FRAME = 0xA5
+MAX_FRAME_LENGTH = 16
+
+RUN_COMMAND = 0x01
+BEGIN_WATERING_COMMAND = 0x09
+
+# Payload layouts following the command byte. The controller reads the payload straight into float unions,
+# so the layout has to match the AVR (little endian, 4 byte floats). Commands not listed here carry no payload.
+
+COMMAND_LAYOUTS = {
+    RUN_COMMAND: struct.Struct("<2f"),
+    BEGIN_WATERING_COMMAND: struct.Struct("<f")
+}
+
+
+def _crc8_table() -> List[int]:
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return table
+
+
+_CRC8_TABLE = _crc8_table()
+
+
+def crc8(data, start: int = 0, end: int = None) -> int:
+    crc = 0
+    table = _CRC8_TABLE
+    for index in range(start, len(data) if end is None else end):
+        crc = table[crc ^ data[index]]
+    return crc
+
+
+def pack_payload(opcode: int, values: tuple, layouts: Dict[int, struct.Struct]) -> bytes:
+    layout = layouts.get(opcode)
+    if layout is None:
+        if values:
+            raise ValueError(f"Opcode {opcode:#04x} does not take a payload.")
+        return b''
+    return layout.pack(*values)
+
+
+class RawCodec:
+
+    name = "raw"
+
+    @staticmethod
+    def encode(opcode: int, *values: float, layouts: Dict[int, struct.Struct] = COMMAND_LAYOUTS) -> bytes:
+        return bytes((opcode,)) + pack_payload(opcode, values, layouts)
+
+    @staticmethod
+    def decoder(layouts: Dict[int, struct.Struct] = None) -> "RawDecoder":
+        return RawDecoder()
+
+
+class RawDecoder:
+
+    # Responses of the raw protocol are single bytes without payloads. Commands with payloads (the controller
+    # side) depend on the controller state and are parsed by the simulator itself.
+
+    crc_errors = 0
+    dropped_bytes = 0
+
+    @staticmethod
+    def feed(data: bytes) -> List[Tuple[int, tuple]]:
+        return [(byte, ()) for byte in data]
+
+
+class FramedCodec:
+
+    name = "framed"
+
+    @staticmethod
+    def encode(opcode: int, *values: float, layouts: Dict[int, struct.Struct] = COMMAND_LAYOUTS) -> bytes:
+        body = bytes((1 + (layouts[opcode].size if opcode in layouts else 0), opcode))
+        body += pack_payload(opcode, values, layouts)
+        return bytes((START_OF_FRAME,)) + body + bytes((crc8(body),))
+
+    @staticmethod
+    def decoder(layouts: Dict[int, struct.Struct] = None) -> "FrameDecoder":
+        return FrameDecoder(layouts or {})
+
+
+class FrameDecoder:
+
+    # Incremental decoder. Received bytes are appended to one buffer and payloads are unpacked in place with
+    # unpack_from. Anything that isn't a valid frame is skipped byte by byte until the next start of frame, so a
+    # dropped or extra byte costs one frame instead of desynchronising the link.
+
+    def __init__(self, layouts: Dict[int, struct.Struct]):
+        self._layouts = layouts
+        self._buffer = bytearray()
+        self.crc_errors = 0
+        self.dropped_bytes = 0
+
+    def feed(self, data: bytes) -> List[Tuple[int, tuple]]:
+        buffer = self._buffer
+        buffer += data
+        messages = []
+        position = 0
+
+        while True:
+            start = buffer.find(START_OF_FRAME, position)
+            if start < 0:
+                self.dropped_bytes += len(buffer) - position
+                position = len(buffer)
+                break
+
+            self.dropped_bytes += start - position
+            position = start
+
+            if len(buffer) - position < 2:
+                break
+
+            length = buffer[position + 1]
+            if not 0 < length <= MAX_FRAME_LENGTH:
+                self.dropped_bytes += 1
+                position += 1
+                continue
+
+            if len(buffer) - position < 3:
+                break
+
+            # The length is implied by the opcode, checking it early avoids waiting for the rest of a frame
+            # whose length byte got corrupted.
+            opcode = buffer[position + 2]
+            layout = self._layouts.get(opcode)
+            if (layout.size if layout else 0) != length - 1:
+                self.dropped_bytes += 1
+                position += 1
+                continue
+
+            end = position + length + 3
+            if len(buffer) < end:
+                break
+
+            if crc8(buffer, position + 1, end - 1) != buffer[end - 1]:
+                self.crc_errors += 1
+                self.dropped_bytes += 1
+                position += 1
+                continue
+
+            values = layout.unpack_from(buffer, position + 3) if layout else ()
+            messages.append((opcode, values))
+            position = end
+
+        del buffer[:position]
+        return messages
+
+
+CODECS = {
+    RawCodec.name: RawCodec,
+    FramedCodec.name: FramedCodec
+}
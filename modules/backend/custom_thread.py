@@ -1,41 +1,244 @@
+import itertools
+import queue
 import threading
+import time
+import traceback
+from concurrent.futures import Future
 from typing import Optional, Callable
-from modules.backend.clinostat_com import ClinostatCommunicationError
+from modules.backend.clinostat_com import ClinostatCommunicationError, ClinostatCommandInterrupted
 
 #  todo: Probably should have used the excepthook.
 
 
-class ClinostatSerialThread(threading.Thread):
-    def __init__(self, serial_lock: threading.Lock,
+class _SerialCommand:
+
+    __slots__ = ("name", "args", "future", "at_start", "at_success", "at_fail")
+
+    def __init__(self, name: str, args: tuple,
                  at_start: Optional[Callable] = None,
                  at_success: Optional[Callable] = None,
-                 at_fail: Optional[Callable] = None,
-                 **kwargs):
+                 at_fail: Optional[Callable] = None):
+        self.name = name
+        self.args = args
+        self.future = Future()
+        self.at_start = at_start
+        self.at_success = at_success
+        self.at_fail = at_fail
+
+
+class ClinostatSerialWorker(threading.Thread):
+
+    # Lower value is executed first. Commands not listed here get the lowest priority.
+    PRIORITIES = {
+        "abort": 0,
+        "pause": 1,
+        "run": 2,
+        "resume": 2,
+        "dump_water": 3,
+        "echo": 4
+    }
 
-        super().__init__(**kwargs)
-        self._at_success = at_success
-        self._at_fail = at_fail
-        self._at_start = at_start
+    # Queued commands that become obsolete once the key command is submitted.
+    SUPERSEDES = {
+        "abort": ("run", "resume", "pause")
+    }
+
+    # Commands that preempt the command currently waiting for the controller.
+    URGENT = ("abort",)
+
+    _LOWEST_PRIORITY = max(PRIORITIES.values()) + 1
+
+    def __init__(self, device, serial_lock: threading.Lock, **kwargs):
+
+        super().__init__(daemon=True, **kwargs)
+        self.device = device
         self.lock = serial_lock
+        self._queue = queue.PriorityQueue()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._order = itertools.count()
+        self._running = True
+        self._current: Optional[_SerialCommand] = None  # Command executed at the moment.
+
+    def submit(self, command: str, *args,
+               at_start: Optional[Callable] = None,
+               at_success: Optional[Callable] = None,
+               at_fail: Optional[Callable] = None) -> Future:
+
+        with self._pending_lock:
+            if not self._running:
+                raise RuntimeError("Serial worker has been stopped.")
+
+            queued = self._pending.get(command)
+            if queued is not None:
+                # Same command still waiting in the queue - send it once, with the most recent arguments.
+                queued.args = args
+                queued.at_start = at_start
+                queued.at_success = at_success
+                queued.at_fail = at_fail
+                return queued.future
+
+            current = self._current
+            if command in ClinostatSerialWorker.URGENT and current is not None and current.name == command:
+                # The same urgent command is already waiting for the controller, interrupting it would only make
+                # the new one wait for a response the idle controller never sends. The UI is updated once it's done.
+                current.at_success = at_success
+                current.at_fail = at_fail
+                return current.future
+
+            for obsolete_name in ClinostatSerialWorker.SUPERSEDES.get(command, ()):
+                obsolete = self._pending.pop(obsolete_name, None)
+                if obsolete is not None:
+                    obsolete.future.cancel()
+
+            entry = _SerialCommand(command, args, at_start, at_success, at_fail)
+            self._pending[command] = entry
+            priority = ClinostatSerialWorker.PRIORITIES.get(command, ClinostatSerialWorker._LOWEST_PRIORITY)
+            self._queue.put((priority, next(self._order), entry))
+
+            # Under the lock, so the worker can't pick the urgent command up in the meantime and interrupt itself.
+            if command in ClinostatSerialWorker.URGENT and current is not None \
+                    and current.name not in ClinostatSerialWorker.URGENT:
+                self.device.interrupt()
+
+        return entry.future
+
+    def stop(self) -> None:
+
+        with self._pending_lock:
+            self._running = False
+            for entry in self._pending.values():
+                entry.future.cancel()
+            self._pending = {}
+            self._queue.put((-1, next(self._order), None))
+
+    def run(self) -> None:
+
+        while True:
+            _, _, entry = self._queue.get()
+
+            if entry is None:
+                return
+
+            with self._pending_lock:
+                if self._pending.get(entry.name) is entry:
+                    del self._pending[entry.name]
+                if not entry.future.set_running_or_notify_cancel():
+                    continue
+                self._current = entry
+
+            self._execute(entry)
+
+    def _execute(self, entry: _SerialCommand) -> None:
+
+        # Nothing raised by the command or its callbacks may end the thread or keep the serial lock, every later
+        # command of the device would wait forever.
+        lock_requested = time.perf_counter()
+        with self.lock:
+            self.device.metrics.record(entry.name, "lock", time.perf_counter() - lock_requested)
+            self._callback(entry.at_start)
+
+            callback = None
+            try:
+                result = getattr(self.device, entry.name)(*entry.args)
+
+            except ClinostatCommandInterrupted as err:
+                # Preempted by an urgent command, which will take care of the UI once it's done.
+                entry.future.set_exception(err)
+
+            except ClinostatCommunicationError as err:
+                entry.future.set_exception(err)
+                callback = "at_fail"
+
+            except Exception as err:
+                traceback.print_exc()
+                entry.future.set_exception(err)
+
+            else:
+                entry.future.set_result(result)
+                callback = "at_success"
+
+            finally:
+                with self._pending_lock:
+                    self._current = None
+                    callback = getattr(entry, callback) if callback else None
+
+            self._callback(callback)
+
+    @staticmethod
+    def _callback(callback: Optional[Callable]) -> None:
+        if callback is None:
+            return
+        try:
+            callback()
+        except Exception:
+            traceback.print_exc()
+
+
+class ClinostatHeartbeat(threading.Thread):
+
+    # Pings the controller in the background to keep the cached device state fresh and to notice an unplugged
+    # device within interval*MAX_MISSES + timeout, instead of at the next user command. on_state is called from the
+    # reader thread of the device as soon as any controller message changes the state, pinged for or not.
+
+    MAX_MISSES = 3
+
+    def __init__(self, device, interval: float = 1., timeout: float = 0.5,
+                 on_state: Optional[Callable] = None,
+                 on_disconnect: Optional[Callable] = None,
+                 **kwargs):
+
+        super().__init__(daemon=True, **kwargs)
+        self.device = device
+        self.interval = interval
+        self.timeout = timeout
+        self._on_state = on_state
+        self._on_disconnect = on_disconnect
+        self._stopped = threading.Event()
+        self.misses = 0
+        self._state = device.state
+        if on_state:
+            device.events.observe(self._state_changed)  # After Clinostat._track_state, the state is already updated.
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._on_state:
+            self.device.events.unobserve(self._state_changed)
+
+    def run(self) -> None:
+
+        while not self._stopped.wait(self.interval):
+
+            # Messages from commands refresh the state too, no need to ping while they keep coming.
+            if self.device.state_age() < self.interval:
+                self.misses = 0
+                continue
+
+            response = None
+            try:
+                response = self.device.ping(self.timeout)
+            except ClinostatCommunicationError:
+                self.misses = ClinostatHeartbeat.MAX_MISSES
+            else:
+                # The firmware doesn't answer echo for the moment it spends in the abort state, hence a few misses
+                # are tolerated.
+                self.misses = 0 if response is not None else self.misses + 1
 
-    def run(self):
+            if self._stopped.is_set():
+                return
 
-        self.lock.acquire()
-        failed = False
-        if self._at_start:
-            self._at_start()
+            if self.misses >= ClinostatHeartbeat.MAX_MISSES:
+                self._stopped.set()
+                if self._on_disconnect:
+                    self._on_disconnect()
+                return
 
+    def _state_changed(self, event) -> None:
+        state = self.device.state
+        if state == self._state or self._stopped.is_set():
+            return
+        self._state = state
         try:
-            if self._target:
-                self._target(*self._args, **self._kwargs)
-
-        except ClinostatCommunicationError:
-            failed = True
-            if self._at_fail:
-                self._at_fail()
-
-        finally:
-            if not failed and self._at_success:
-                self._at_success()
-            self.lock.release()
-            del self._target, self._args, self._kwargs
\ No newline at end of file
+            self._on_state(state)
+        except Exception:
+            traceback.print_exc()  # Would otherwise end the reader thread.
@@ -1,107 +1,276 @@
-import queue
+import asyncio
+import collections
+import os
 import socket
+import stat
+import struct
 import threading
-from typing import Callable
+import time
+from typing import Callable, Optional, List
+from modules.backend.framing import FrameBuffer, encode_frame
+from chamber.modules import telemetry
 
 
 class DataServer:
 
-    def __init__(self, address="127.0.0.1", port=8888):
-        self.socket = None
+    # Serves any number of chamber connections on one asyncio event loop, running on its own thread. Every
+    # connection streams frames of one or more samples. Every frame is decoded into a list of telemetry.Sample
+    # objects and put into the receive queue as one item, usually a TelemetryHub that hands it to every consumer.
+    # The sample format is negotiated per connection. The queue is filled from the event loop, a queue that blocks
+    # when full holds up every connection until it has room again.
+    #
+    # Light setpoints are pushed with push_control. Only the most recent one is kept: chambers that negotiated the
+    # control channel get it right away and acknowledge it, older chambers get it as the answer to their next sample
+    # frame. Each chamber only ever gets the latest setpoint, however many were pushed in the meantime.
+    #
+    # With socket_path set the server listens on a unix domain socket instead of TCP, for a chamber (or the chamber
+    # dummy) running on the same machine.
+
+    READ_TIMEOUT = 30  # s, connections that stay silent for longer are closed.
+    SHUTDOWN_TIMEOUT = 5
+    BACKLOG = 512
+    CONTROL_HISTORY = 1000  # Acknowledgement round trips kept.
+
+    def __init__(self, address="127.0.0.1", port=8888, read_timeout: float = READ_TIMEOUT,
+                 socket_path: Optional[str] = None):
         self.server_thread = None
         self.notify = None
         self.running = False
         self.address = address
         self.port = port
+        self.socket_path = socket_path
+        self.read_timeout = read_timeout
         self.HEADER_SIZE = 10
         self._containers = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections = set()
+        self._control_lock = threading.Lock()
+        self._control: Optional[str] = None
+        self._control_seq = 0
+        self._control_scheduled = False
+        self.control_rtt = collections.deque(maxlen=DataServer.CONTROL_HISTORY)  # s
 
     def run_server(self) -> None:
+        if not self._containers.get("receive"):
+            raise RuntimeError("Receiving queue must be attached. Use the attachReceiveQueue method.")
+
+        if self.socket_path and not hasattr(socket, "AF_UNIX"):
+            if self.notify:
+                self.notify("Unix sockets are not supported on this system.", headline="TCP ERROR: ", msg_type="ERROR")
+            raise ServerStartupError("Unix sockets are not supported on this system.")
+
+        self._loop = asyncio.new_event_loop()
+        self._control_scheduled = False
         try:
-            self.socket = socket.create_server((self.address, self.port), family=socket.AF_INET)
+            if self.socket_path:
+                self._remove_stale_socket()
+                server = self._loop.create_unix_server(lambda: _ChamberConnection(self), self.socket_path,
+                                                       backlog=DataServer.BACKLOG)
+            else:
+                server = self._loop.create_server(lambda: _ChamberConnection(self), self.address, self.port,
+                                                  backlog=DataServer.BACKLOG)
+            self._server = self._loop.run_until_complete(server)
         except OSError as err:
+            self._loop.close()
+            self._loop = None
+            message = err.strerror or str(err)
             if self.notify:
-                self.notify(err.args[1], headline="TCP ERROR: ", msg_type="ERROR")
-            raise ServerStartupError(err.args[1])
+                self.notify(message, headline="TCP ERROR: ", msg_type="ERROR")
+            raise ServerStartupError(message)
+
         self.running = True
         if self.notify:
-            self.notify(f"Successfully connected to: {self.address}", headline="TCP: ", msg_type="TCP")
-        self.server_thread = threading.Thread(target=self._server_loop)
+            self.notify(f"Successfully connected to: {self.endpoint}", headline="TCP: ", msg_type="TCP")
+        self.server_thread = threading.Thread(target=self._loop.run_forever, daemon=True)
         self.server_thread.start()
 
-    def _server_loop(self) -> None:
+    def close_server(self) -> None:
+        if not self.running:
+            return
+        self.running = False
 
-        self.socket.listen()
+        close_failed = False
+        try:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result(DataServer.SHUTDOWN_TIMEOUT)
+        except Exception:
+            close_failed = True
 
-        if self._containers["response"]:
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self.server_thread.join()
+            self._loop.close()
+            self._loop = None
+            self._server = None
+            if self.socket_path:
+                self._remove_stale_socket()
 
-            while self.running:
+        if not close_failed and self.notify:
+            self.notify("Connection to server closed.", headline="TCP: ", msg_type="TCP")
 
-                try:
-                    client, address = self.socket.accept()
-                except(socket.timeout, OSError):
-                    return
-                finally:
-                    if not self.running:
-                        return
+    async def _shutdown(self) -> None:
+        self._server.close()
+        for connection in list(self._connections):
+            connection.close()
+        await self._server.wait_closed()
 
-                with client:
-                    fresh = True
-                    message = ''
-                    while True:
-                        data = client.recv(16)
-                        data = data.decode('utf-8')
+    @property
+    def endpoint(self) -> str:
+        return self.socket_path if self.socket_path else f"{self.address}:{self.port}"
 
-                        if fresh:
-                            message_len = int(data[:self.HEADER_SIZE])
-                            fresh = False
-                            message += data[self.HEADER_SIZE:]
+    def _remove_stale_socket(self) -> None:
+        # Left behind by a server that wasn't closed, binding fails while it exists.
+        try:
+            if stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+                os.unlink(self.socket_path)
+        except OSError:
+            pass
 
-                        else:
-                            message += data
+    def link_output(self, link: Callable) -> None:
+        self.notify = link
 
-                        if len(message) == message_len:
-                            break
+    def attach_receive_queue(self, queue_) -> None:
+        self._containers["receive"] = queue_
 
-                    self._containers["receive"].put(message)
+    def push_control(self, message: str) -> None:
+        # Thread safe. Setpoints pushed before the loop gets to send the previous one replace it.
+        with self._control_lock:
+            self._control = message
+            self._control_seq += 1
+            if self._control_scheduled or not self.running:
+                return
+            self._control_scheduled = True
+        self._loop.call_soon_threadsafe(self._send_control)
 
-                    if self._containers["response"]:
-                        if not self._containers["response"].empty():
-                            response = str(self._containers["response"].get())
-                            self._containers["response"].task_done()
-                        else:
-                            response = "default"
-                        response = f"{len(response):<{self.HEADER_SIZE}}" + response
-                        client.sendall(response.encode())
-        else:
-            raise RuntimeError("Receiving queue must be attached. Use the attachReceiveQueue method.")
+    def current_control(self):
+        with self._control_lock:
+            return self._control_seq, self._control
 
-    def close_server(self) -> None:
-        self.running = False
-        close_failed = False
+    def control_report(self) -> Optional[str]:
+        rtt = sorted(self.control_rtt)
+        if not rtt:
+            return None
+        return (f"{len(rtt)} light setpoints acknowledged, round trip p50={rtt[len(rtt) // 2] * 1000:.1f} ms, "
+                f"max={rtt[-1] * 1000:.1f} ms.")
+
+    def _send_control(self) -> None:
+        with self._control_lock:
+            self._control_scheduled = False
+        for connection in list(self._connections):
+            if connection.push:
+                connection.send_control()
+
+    def _handle_samples(self, samples: List[telemetry.Sample]) -> None:
+        self._containers["receive"].put(samples)
+
+
+class _ChamberConnection(asyncio.BufferedProtocol):
+
+    # Data is received straight into the frame buffer of the connection.
+
+    def __init__(self, server: DataServer):
+        self.server = server
+        self.frames = FrameBuffer(server.HEADER_SIZE)
+        self.transport: Optional[asyncio.Transport] = None
+        self.peer = None
+        self.format: Optional[str] = None  # Sample format, negotiated with the first frame.
+        self.push = False  # Control channel negotiated.
+        self.control_seq = 0  # Last setpoint sent.
+        self._control_sent = 0.
+        self._loop = asyncio.get_running_loop()
+        self._last_read = 0.
+        self._timeout_handle: Optional[asyncio.TimerHandle] = None
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+        peer = transport.get_extra_info("peername")
+        self.peer = peer[0] if isinstance(peer, tuple) else "local socket"
+        self.server._connections.add(self)
+        self._last_read = self._loop.time()
+        self._timeout_handle = self._loop.call_later(self.server.read_timeout, self._check_timeout)
+        if self.server.notify:
+            self.server.notify(f"Chamber connected from {self.peer}.", headline="TCP: ", msg_type="TCP")
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.frames.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self.frames.buffer_updated(nbytes)
+        self._last_read = self._loop.time()
 
         try:
-            self.socket.shutdown(socket.SHUT_RDWR)
+            frame = self.frames.next_frame()
+            while frame is not None:
+                self._handle_frame(frame)
+                frame = self.frames.next_frame()
+        except (ValueError, struct.error):
+            self.transport.abort()  # Malformed frame, the chamber reconnects.
 
-        except OSError:
-            close_failed = True
+    def _handle_frame(self, frame: memoryview) -> None:
+        if self.format is None:
+            offered = telemetry.decode_hello(frame)
+            if offered is not None:
+                self.format = telemetry.choose_format(offered)
+                self.push = telemetry.PUSH in offered
+                accepted = (self.format, telemetry.PUSH) if self.push else (self.format,)
+                self._write(telemetry.encode_hello(accepted))
+                if self.push:
+                    self.send_control()  # Setpoint from before the chamber connected.
+                return
+            self.format = telemetry.TEXT  # Chamber from before the negotiation.
 
-        finally:
+        if not self.push:
+            self.server._handle_samples(telemetry.decode_batch(frame, self.format))
+            self._write(self._legacy_response())
+            return
 
-            if not close_failed and self.notify:
-                self.notify("Connection to server closed.", headline="TCP: ", msg_type="TCP")
+        kind = bytes(frame[:1])
+        if kind == telemetry.KIND_SAMPLES:
+            self.server._handle_samples(telemetry.decode_batch(frame[1:], self.format))
+        elif kind == telemetry.KIND_ACK:
+            if int(bytes(frame[1:])) == self.control_seq:
+                self.server.control_rtt.append(time.perf_counter() - self._control_sent)
+        else:
+            raise ValueError(f"Unknown frame kind: {kind}.")
 
-            self.socket.close()
-            self.socket = None
+    def _legacy_response(self) -> bytes:
+        seq, message = self.server.current_control()
+        if seq == self.control_seq or message is None:
+            return b"default"
+        self.control_seq = seq
+        return message.encode()
 
-    def link_output(self, link: Callable) -> None:
-        self.notify = link
+    def send_control(self) -> None:
+        seq, message = self.server.current_control()
+        if seq == self.control_seq or message is None:
+            return
+        self.control_seq = seq
+        self._control_sent = time.perf_counter()
+        self._write(telemetry.encode_control(seq, message))
 
-    def attach_receive_queue(self, queue_: queue.Queue) -> None:
-        self._containers["receive"] = queue_
+    def _write(self, payload: bytes) -> None:
+        self.transport.write(encode_frame(payload, self.server.HEADER_SIZE))
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        if self._timeout_handle:
+            self._timeout_handle.cancel()
+        self.server._connections.discard(self)
+        if self.server.running and self.server.notify:
+            self.server.notify(f"Chamber at {self.peer} disconnected.", headline="TCP: ", msg_type="TCP")
+
+    def close(self) -> None:
+        self.transport.abort()
+
+    def _check_timeout(self) -> None:
+        # One timer per connection, re-armed for the remaining time instead of being replaced on every read.
+        remaining = self._last_read + self.server.read_timeout - self._loop.time()
+        if remaining > 0:
+            self._timeout_handle = self._loop.call_later(remaining, self._check_timeout)
+            return
 
-    def attach_response_queue(self, queue_: queue.Queue) -> None:
-        self._containers["response"] = queue_
+        if self.server.notify:
+            self.server.notify(f"Chamber at {self.peer} timed out.", headline="TCP ERROR: ", msg_type="ERROR")
+        self.transport.abort()
 
 
 class ServerStartupError(Exception):
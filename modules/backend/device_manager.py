@@ -0,0 +1,121 @@
+import threading
+from typing import Dict, List, Optional, Callable
+from modules.backend import clinostat_com
+from modules.backend.custom_thread import ClinostatSerialWorker, ClinostatHeartbeat
+from modules.backend.serial_metrics import SerialMetrics
+
+
+class DeviceHandle:
+
+    # Everything that belongs to one connected clinostat. Every device has its own serial lock, command worker and
+    # heartbeat, so commands to different devices run in parallel and a stuck port only blocks its own commands.
+
+    def __init__(self, device: clinostat_com.Clinostat, metrics: SerialMetrics):
+        self.port_name = device.port_name
+        self.device = device
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.worker = ClinostatSerialWorker(device, self.lock)
+        self.heartbeat: Optional[ClinostatHeartbeat] = None
+        self.sequence = None
+
+        # Watering cycle, scheduled by the app for every device, not only the one shown in the UI.
+        self.pumping = False
+        self.water_volume = 0.
+        self.water_interval = 0.  # min
+        self.pump_time = 0.
+
+        # Values of the UI controls while another device is shown.
+        self.settings = {}
+
+    def stop_threads(self) -> None:
+        if self.sequence:
+            self.sequence.stop()
+            self.sequence = None
+
+        if self.heartbeat:
+            self.heartbeat.stop()
+
+        self.worker.stop()
+
+    def close(self) -> None:
+        self.stop_threads()
+        self.device.close_serial()
+
+
+class DeviceManager:
+
+    def __init__(self, protocol: str = "raw", heartbeat_interval: float = 1., heartbeat_timeout: float = 0.5):
+        self.protocol = protocol
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self._handles: Dict[str, DeviceHandle] = {}
+        self._lock = threading.Lock()
+        self.active: Optional[DeviceHandle] = None
+
+    def connect(self, port_name: str,
+                on_state: Optional[Callable] = None,
+                on_disconnect: Optional[Callable] = None) -> DeviceHandle:
+
+        # on_state(handle, state) is called from the reader thread of the device when its state changes,
+        # on_disconnect(handle) from its heartbeat.
+        with self._lock:
+            if port_name in self._handles:
+                raise ValueError(f"Already connected to {port_name}.")
+
+        metrics = SerialMetrics()
+        device = clinostat_com.Clinostat(port_name, metrics=metrics, protocol=self.protocol)
+        handle = DeviceHandle(device, metrics)
+        handle.heartbeat = ClinostatHeartbeat(
+            device,
+            interval=self.heartbeat_interval,
+            timeout=self.heartbeat_timeout,
+            on_state=(lambda state: on_state(handle, state)) if on_state else None,
+            on_disconnect=(lambda: on_disconnect(handle)) if on_disconnect else None)
+
+        with self._lock:
+            self._handles[port_name] = handle
+            if self.active is None:
+                self.active = handle
+
+        handle.worker.start()
+        handle.heartbeat.start()
+        return handle
+
+    def remove(self, handle: DeviceHandle) -> bool:
+        # Forgets the device without touching the port. Returns False if it was already removed.
+        with self._lock:
+            if self._handles.get(handle.port_name) is not handle:
+                return False
+            del self._handles[handle.port_name]
+            if self.active is handle:
+                self.active = next(iter(self._handles.values()), None)
+            return True
+
+    def disconnect(self, handle: DeviceHandle) -> None:
+        self.remove(handle)
+        handle.close()
+
+    def close_all(self) -> None:
+        for handle in self.handles():
+            try:
+                self.disconnect(handle)
+            except clinostat_com.ClinostatCommunicationError:
+                pass
+
+    def select(self, port_name: str) -> DeviceHandle:
+        with self._lock:
+            self.active = self._handles[port_name]
+            return self.active
+
+    def get(self, port_name: str) -> Optional[DeviceHandle]:
+        with self._lock:
+            return self._handles.get(port_name)
+
+    def handles(self) -> List[DeviceHandle]:
+        with self._lock:
+            return list(self._handles.values())
+
+    def port_names(self) -> List[str]:
+        with self._lock:
+            return list(self._handles)
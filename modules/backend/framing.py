@@ -0,0 +1,73 @@
+from typing import Optional
+
+# Length-prefixed frames exchanged with the chamber: a HEADER_SIZE bytes long ASCII length, left aligned and padded
+# with spaces, followed by the payload.
+
+HEADER_SIZE = 10
+BUFFER_SIZE = 64 * 1024
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class FrameBuffer:
+
+    # Received bytes are written straight into one preallocated buffer (get_buffer/buffer_updated, the same contract
+    # as asyncio.BufferedProtocol) and complete frames are handed out as memoryviews of it, without copying or
+    # decoding the data chunk by chunk. A frame stays valid until the next get_buffer call.
+
+    def __init__(self, header_size: int = HEADER_SIZE, size: int = BUFFER_SIZE, max_frame_size: int = MAX_FRAME_SIZE):
+        self.header_size = header_size
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._frame_size: Optional[int] = None
+
+    def get_buffer(self, size_hint: int = -1) -> memoryview:
+        required = max(size_hint, 1)
+        if self._frame_size is not None:
+            required = max(required, self.header_size + self._frame_size - (self._end - self._start))
+
+        if len(self._buffer) - self._end < required:
+            pending = self._end - self._start
+            if pending + required > len(self._buffer):
+                # A frame larger than the buffer, the buffer only ever grows.
+                buffer = bytearray(max(2 * len(self._buffer), pending + required))
+                buffer[:pending] = self._view[self._start:self._end]
+                self._buffer = buffer
+                self._view = memoryview(buffer)
+            elif pending:
+                self._buffer[:pending] = self._buffer[self._start:self._end]
+            self._start = 0
+            self._end = pending
+
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self._end += nbytes
+
+    def next_frame(self) -> Optional[memoryview]:
+        # None until a whole frame has been received.
+        available = self._end - self._start
+
+        if self._frame_size is None:
+            if available < self.header_size:
+                return None
+            self._frame_size = int(self._buffer[self._start:self._start + self.header_size])
+            if not 0 <= self._frame_size <= self.max_frame_size:
+                raise ValueError(f"Invalid frame size: {self._frame_size}.")
+
+        end = self._start + self.header_size + self._frame_size
+        if end > self._end:
+            return None
+
+        frame = self._view[self._start + self.header_size:end]
+        self._start = end
+        self._frame_size = None
+        if self._start == self._end:
+            self._start = self._end = 0
+        return frame
+
+
+def encode_frame(payload: bytes, header_size: int = HEADER_SIZE) -> bytes:
+    return f"{len(payload):<{header_size}}".encode() + payload
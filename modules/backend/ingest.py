@@ -0,0 +1,195 @@
+import collections
+import queue
+import threading
+from typing import Optional, Callable
+
+
+class IngestBuffer:
+
+    # Bounded buffer between the DataServer and a consumer of the received samples. What happens to a new item when
+    # the buffer is full depends on the policy:
+    # block - the producer waits for the consumer, up to block_timeout, after that the item is dropped,
+    # drop_oldest - the oldest item is dropped,
+    # latest - only the newest item is kept, for consumers that only show the current state.
+    # With maxsize None the buffer is never full and put never waits or drops.
+    # notify is called from the producer thread after every stored item, for consumers that don't poll.
+
+    BLOCK = "block"
+    DROP_OLDEST = "drop_oldest"
+    LATEST = "latest"
+    POLICIES = (BLOCK, DROP_OLDEST, LATEST)
+
+    MAXSIZE = 256
+    BLOCK_TIMEOUT = 1.  # s, keeps a stalled consumer from stopping the server for good.
+
+    def __init__(self, maxsize: Optional[int] = MAXSIZE, policy: str = DROP_OLDEST,
+                 block_timeout: float = BLOCK_TIMEOUT, notify: Optional[Callable] = None):
+        if policy not in IngestBuffer.POLICIES:
+            raise ValueError(f"Unknown ingest policy: {policy}.")
+        self.policy = policy
+        if policy == IngestBuffer.LATEST:
+            self.maxsize = 1
+        else:
+            self.maxsize = None if maxsize is None else max(1, maxsize)
+        self.block_timeout = block_timeout
+        self.notify = notify
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self.received = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def put(self, item) -> bool:
+        # False if the item, or an older one, had to be dropped.
+        with self._lock:
+            self.received += 1
+            dropped = False
+
+            if self.maxsize is not None and len(self._items) >= self.maxsize:
+                if self.policy == IngestBuffer.BLOCK:
+                    if not self._not_full.wait_for(lambda: len(self._items) < self.maxsize, self.block_timeout):
+                        self.dropped += 1
+                        return False
+                else:
+                    self._items.popleft()
+                    self.dropped += 1
+                    dropped = True
+
+            self._items.append(item)
+            self.high_water = max(self.high_water, len(self._items))
+            self._not_empty.notify()
+
+        if self.notify:
+            self.notify()
+        return not dropped
+
+    def get(self, block: bool = True, timeout: Optional[float] = None):
+        with self._lock:
+            if not self._items and (not block or not self._not_empty.wait_for(lambda: self._items, timeout)):
+                raise queue.Empty
+            item = self._items.popleft()
+            self._not_full.notify()
+            return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def empty(self) -> bool:
+        with self._lock:
+            return not self._items
+
+    def qsize(self) -> int:
+        with self._lock:
+            return len(self._items)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self._not_full.notify_all()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {"policy": self.policy, "size": len(self._items), "maxsize": self.maxsize,
+                    "high_water": self.high_water, "received": self.received, "dropped": self.dropped}
+
+    def reset_metrics(self) -> None:
+        with self._lock:
+            self.received = self.dropped = 0
+            self.high_water = len(self._items)
+
+
+class TelemetryHub:
+
+    # Hands every received batch to all subscribers. Each subscriber gets its own IngestBuffer, so a slow one only
+    # loses its own items and never holds up the others. DataServer takes the hub as its receive queue and puts from
+    # its event loop, hence the block policy is refused: a full buffer would stall every chamber connection.
+    # Subscribers that have to get everything, like the recorder, subscribe with maxsize None instead.
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, name: str, maxsize: Optional[int] = IngestBuffer.MAXSIZE,
+                  policy: str = IngestBuffer.DROP_OLDEST, notify: Optional[Callable] = None) -> IngestBuffer:
+        if policy == IngestBuffer.BLOCK:
+            raise ValueError("Hub subscribers can't block the server, subscribe with maxsize None instead.")
+        buffer = IngestBuffer(maxsize=maxsize, policy=policy, notify=notify)
+        with self._lock:
+            if name in self._subscribers:
+                raise ValueError(f"Already subscribed: {name}.")
+            self._subscribers[name] = buffer
+        return buffer
+
+    def unsubscribe(self, name: str) -> None:
+        with self._lock:
+            self._subscribers.pop(name, None)
+
+    def put(self, item) -> None:
+        with self._lock:
+            subscribers = list(self._subscribers.values())
+        for buffer in subscribers:
+            buffer.put(item)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            subscribers = dict(self._subscribers)
+        return {name: buffer.metrics() for name, buffer in subscribers.items()}
+
+    def reset_metrics(self) -> None:
+        with self._lock:
+            subscribers = list(self._subscribers.values())
+        for buffer in subscribers:
+            buffer.reset_metrics()
+
+
+class DataRecorder(threading.Thread):
+
+    # Appends every received sample to the data file, so the file stays complete whatever the GUI drops. Batches that
+    # piled up while writing are written together. After stop, whatever is still in the buffer is written before the
+    # thread ends, join it once nothing is put into the buffer anymore.
+
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, path: str, buffer: IngestBuffer, **kwargs):
+        super().__init__(daemon=True, **kwargs)
+        self.path = path
+        self.buffer = buffer
+        self._file_lock = threading.Lock()
+        self._running = True
+
+    def stop(self) -> None:
+        self._running = False
+
+    def clear(self) -> None:
+        with self._file_lock:
+            with open(self.path, "w"):
+                pass
+
+    def run(self) -> None:
+        while self._running:
+            try:
+                batches = [self.buffer.get(timeout=DataRecorder.POLL_INTERVAL)]
+            except queue.Empty:
+                continue
+            self._write(batches + self._drain())
+
+        self._write(self._drain())
+
+    def _drain(self) -> list:
+        batches = []
+        try:
+            while True:
+                batches.append(self.buffer.get_nowait())
+        except queue.Empty:
+            return batches
+
+    def _write(self, batches: list) -> None:
+        if not batches:
+            return
+        lines = "".join(";".join(f"{value:.9g}" for value in sample.values) + "\n"
+                        for batch in batches for sample in batch)
+        with self._file_lock:
+            with open(self.path, "a") as file:
+                file.write(lines)
@@ -0,0 +1,163 @@
+import csv
+import threading
+import time
+from concurrent.futures import CancelledError
+from typing import Optional, Callable, List, NamedTuple
+from modules.backend.clinostat_com import ClinostatCommunicationError, ClinostatCommandInterrupted
+from modules.backend.clinostat_mechanics import ramp_time
+
+
+class SequenceStep(NamedTuple):
+    time: float  # Seconds from the start of the sequence.
+    rpm1: float
+    rpm2: float
+
+
+class StepReport(NamedTuple):
+    index: int
+    step: SequenceStep
+    planned: float  # Seconds from the start, shifted by the time the sequence was held.
+    actual: float  # When the controller acknowledged the new speeds.
+    drift: float
+
+
+def load_sequence(path: str) -> List[SequenceStep]:
+    # CSV rows of time [s], 1st DOF speed [RPM], 2nd DOF speed [RPM]. A header row is optional. Speeds of 0 stop
+    # the motors until the next step. The firmware runs both motors or neither, so a single zero speed is rejected.
+    steps = []
+    with open(path, "r", newline="") as file:
+        for row in csv.reader(file):
+            if not row or row[0].strip().startswith("#"):
+                continue
+            try:
+                step = SequenceStep(*(float(value) for value in row[:3]))
+            except (ValueError, TypeError):
+                if steps:
+                    raise ValueError(f"Invalid sequence row: {row}")
+                continue
+
+            if step.time < 0 or step.rpm1 < 0 or step.rpm2 < 0:
+                raise ValueError(f"Negative value in sequence row: {row}")
+            if (step.rpm1 == 0) != (step.rpm2 == 0):
+                raise ValueError(f"Only one of the speeds is 0 in sequence row: {row}, both have to be 0 to stop.")
+            steps.append(step)
+
+    if not steps:
+        raise ValueError("Sequence file contains no steps.")
+    steps.sort(key=lambda step: step.time)
+    return steps
+
+
+class SequenceRunner(threading.Thread):
+
+    # Executes a speed schedule through the serial worker. The firmware only accepts new speeds from the idle
+    # state, so a switch while running is a soft stop followed by a run. The soft stop is sent ahead of the step by
+    # the expected ramp down, the run is sent at the step time. The reported drift is the lateness of the run.
+
+    def __init__(self, worker, device, steps: List[SequenceStep],
+                 on_step: Optional[Callable] = None,
+                 on_finish: Optional[Callable] = None,
+                 on_fail: Optional[Callable] = None,
+                 **kwargs):
+
+        super().__init__(daemon=True, **kwargs)
+        self.worker = worker
+        self.device = device
+        self.steps = steps
+        self.reports: List[StepReport] = []
+        self._on_step = on_step
+        self._on_finish = on_finish
+        self._on_fail = on_fail
+        self._wakeup = threading.Event()
+        self._state_lock = threading.Lock()
+        self._stopped = False
+        self._held_since: Optional[float] = None
+        self._held_total = 0.
+        self._start = 0.
+        self._speeds: Optional[tuple] = None  # Running speeds and when they were acknowledged, from the start.
+        self._ramp_start = 0.
+
+    def hold(self) -> None:
+        # The motors were paused from outside, the schedule is frozen until release.
+        with self._state_lock:
+            if self._held_since is None:
+                self._held_since = time.monotonic()
+
+    def release(self) -> None:
+        with self._state_lock:
+            if self._held_since is not None:
+                self._held_total += time.monotonic() - self._held_since
+                self._held_since = None
+                self._ramp_start = time.monotonic() - self._start  # Resumed, the motors ramp up again.
+        self._wakeup.set()
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._wakeup.set()
+
+    def run(self) -> None:
+
+        self._start = time.monotonic()
+
+        for index, step in enumerate(self.steps):
+            if not self._wait_until(step.time, self._stop_lead):
+                return
+
+            try:
+                if not self._switch(step):
+                    return
+            except (ClinostatCommandInterrupted, CancelledError, RuntimeError):
+                return  # Aborted from the UI or the device got disconnected.
+            except ClinostatCommunicationError:
+                if self._on_fail:
+                    self._on_fail()
+                return
+
+            actual = time.monotonic() - self._start
+            planned = step.time + self._held_total
+            report = StepReport(index, step, planned, actual, actual - planned)
+            self.reports.append(report)
+            if self._on_step:
+                self._on_step(report)
+
+        if self._on_finish and not self._stopped:
+            self._on_finish(self.reports)
+
+    def _wait_until(self, step_time: float, lead: Optional[Callable] = None) -> bool:
+        while not self._stopped:
+            with self._state_lock:
+                held = self._held_since is not None
+                deadline = self._start + step_time + self._held_total
+                if lead is not None:
+                    deadline -= lead(step_time + self._held_total)
+
+            timeout = None if held else deadline - time.monotonic()
+            if timeout is not None and timeout <= 0:
+                return True
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+        return False
+
+    def _stop_lead(self, planned: float) -> float:
+        # Time the motors take to stop from the running speeds. Motors stopped before they reached the speed ramp
+        # down as long as they ramped up, hence at most half the time since the run.
+        if self._speeds is None:
+            return 0.
+        return min(max(ramp_time(rpm) for rpm in self._speeds), max(0., planned - self._ramp_start) / 2)
+
+    def _switch(self, step: SequenceStep) -> bool:
+        if self.device.state == "running":
+            self.worker.submit("pause").result()
+        self._speeds = None
+
+        if step.rpm1 > 0:
+            # Also waits out a soft stop that was quicker than expected, the run is never sent early.
+            if not self._wait_until(step.time):
+                return False
+            if self.device.state == "running":  # Resumed from the UI with the previous step's speeds.
+                self.worker.submit("pause").result()
+            self.worker.submit("run", (step.rpm1, step.rpm2)).result()
+            with self._state_lock:
+                self._speeds = (step.rpm1, step.rpm2)
+                self._ramp_start = time.monotonic() - self._start
+        return not self._stopped
@@ -0,0 +1,107 @@
+import collections
+import contextlib
+import threading
+import time
+import yaml
+from datetime import datetime
+from typing import Optional
+
+
+class SerialMetrics:
+
+    # Round trip timings of the clinostat commands. Every command is split into phases:
+    # lock - waiting for the serial worker lock, write - writing the packet to the port,
+    # response - waiting for the controller, total - the whole command including console updates.
+
+    PHASES = ("lock", "write", "response", "total")
+    HISTORY = 1000  # Samples kept per command and phase.
+
+    def __init__(self, history: int = HISTORY):
+        self._history = history
+        self._lock = threading.Lock()
+        self._samples = collections.defaultdict(lambda: collections.deque(maxlen=self._history))
+        self._counters = collections.defaultdict(collections.Counter)
+        self._scope = threading.local()
+
+    @contextlib.contextmanager
+    def measure(self, command: str):
+        # Yields the outcome record of the command, a failure is counted as an error unless the caller
+        # classifies it differently (timeouts, interrupted).
+        self._scope.command = command
+        outcome = {"result": "ok"}
+        start = time.perf_counter()
+        try:
+            yield outcome
+        except Exception:
+            if outcome["result"] == "ok":
+                outcome["result"] = "errors"
+            raise
+        finally:
+            self.record(command, "total", time.perf_counter() - start)
+            with self._lock:
+                self._counters[command][outcome["result"]] += 1
+            self._scope.command = None
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        # Attributed to the command measured on the calling thread, ignored outside of measure().
+        command = getattr(self._scope, "command", None)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if command is not None:
+                self.record(command, name, time.perf_counter() - start)
+
+    def record(self, command: str, phase: str, duration: float) -> None:
+        with self._lock:
+            self._samples[(command, phase)].append(duration)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._samples.clear()
+            self._counters.clear()
+
+    def summary(self) -> dict:
+        with self._lock:
+            samples = {key: sorted(values) for key, values in self._samples.items()}
+            counters = {command: dict(counter) for command, counter in self._counters.items()}
+
+        summary = {}
+        for command in sorted({command for command, _ in samples} | set(counters)):
+            entry = {"count": sum(counters.get(command, {}).values()),
+                     "timeouts": counters.get(command, {}).get("timeouts", 0),
+                     "errors": counters.get(command, {}).get("errors", 0),
+                     "interrupted": counters.get(command, {}).get("interrupted", 0)}
+            for phase in SerialMetrics.PHASES:
+                values = samples.get((command, phase))
+                if values:
+                    entry[phase] = {"p50_ms": _percentile(values, 50) * 1000,
+                                    "p95_ms": _percentile(values, 95) * 1000,
+                                    "max_ms": values[-1] * 1000}
+            summary[command] = entry
+        return summary
+
+    def report_lines(self) -> list:
+        lines = []
+        for command, entry in self.summary().items():
+            line = f"{command}: n={entry['count']}"
+            total = entry.get("total")
+            if total:
+                line += f", p50={total['p50_ms']:.1f} ms, p95={total['p95_ms']:.1f} ms, max={total['max_ms']:.1f} ms"
+            lock = entry.get("lock")
+            if lock:
+                line += f", lock p95={lock['p95_ms']:.1f} ms"
+            line += f", timeouts={entry['timeouts']}, errors={entry['errors']}"
+            lines.append(line)
+        return lines
+
+    def dump(self, path: str, port_name: Optional[str] = None) -> None:
+        with open(path, "w") as file:
+            yaml.dump({"date": str(datetime.now()), "port": port_name, "commands": self.summary()},
+                      file, sort_keys=False)
+
+
+def _percentile(sorted_values: list, percent: float) -> float:
+    index = min(len(sorted_values) - 1, int(round(percent / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
@@ -0,0 +1,79 @@
+import numpy as np
+from scipy import fft
+from typing import Optional, Tuple
+
+
+class SlidingSpectrum:
+
+    # Magnitude spectra of the last `length` samples of a few series (the gravity vector axes), updated with a sliding
+    # DFT: every new sample updates the length // 2 + 1 bins of each series in O(bins), instead of transforming the
+    # whole window again.
+    #
+    # The bins are kept for the unwindowed (rectangular) window, with the phase referenced to the oldest sample.
+    # Hann and Hamming windows are applied in the frequency domain, as a three tap kernel over neighbouring bins, when
+    # the magnitudes are read. Rounding errors of the recursion add up, so every resync_interval samples the bins are
+    # recomputed exactly from the samples in the window with rfft.
+
+    WINDOWS = {"rect": (0., 1., 0.), "hann": (-0.25, 0.5, -0.25), "hamming": (-0.23, 0.54, -0.23)}
+
+    def __init__(self, length: int, sample_rate: float, series: int = 3, window: str = "hann",
+                 resync_interval: Optional[int] = None):
+        if window not in SlidingSpectrum.WINDOWS:
+            raise ValueError(f"Unknown window: {window}.")
+        if length < 2:
+            raise ValueError("The window has to be at least 2 samples long.")
+        self.length = length
+        self.series = series
+        self.window = window
+        self.resync_interval = resync_interval or length
+        self.frequencies = fft.rfftfreq(length, 1. / sample_rate)
+        self._twiddle = np.exp(2j * np.pi * np.arange(len(self.frequencies)) / length)
+        self.reset()
+
+    def reset(self) -> None:
+        self._samples = np.zeros((self.series, self.length))  # Ring of the samples in the window.
+        self._oldest = 0
+        self._bins = np.zeros((self.series, len(self.frequencies)), dtype=complex)
+        self._since_resync = 0
+
+    def append(self, values) -> None:
+        # One sample of every series.
+        values = np.asarray(values, dtype=float)
+        self._bins += values[:, np.newaxis] - self._samples[:, self._oldest, np.newaxis]
+        self._bins *= self._twiddle
+        self._samples[:, self._oldest] = values
+        self._oldest = (self._oldest + 1) % self.length
+
+        self._since_resync += 1
+        if self._since_resync >= self.resync_interval:
+            self.resync()
+
+    def extend(self, block) -> None:
+        # A row per sample, a column per series. Blocks longer than the window replace it and are transformed at once.
+        block = np.asarray(block, dtype=float)
+        if len(block) < self.length:
+            for values in block:
+                self.append(values)
+            return
+
+        self._samples[:] = block[-self.length:].T
+        self._oldest = 0
+        self.resync()
+
+    def resync(self) -> None:
+        window = np.roll(self._samples, -self._oldest, axis=1)  # Oldest sample first.
+        self._bins = fft.rfft(window, axis=1)
+        self._since_resync = 0
+
+    def magnitudes(self) -> Tuple[np.ndarray, np.ndarray]:
+        # The frequencies and a row of magnitudes per series.
+        before, centre, after = SlidingSpectrum.WINDOWS[self.window]
+        if not before and not after:
+            return self.frequencies, np.abs(self._bins)
+
+        # Bins next to the first and the last one, from the symmetry of the spectrum of a real signal.
+        last_mirror = self._bins[:, -2] if self.length % 2 == 0 else self._bins[:, -1]
+        padded = np.concatenate((np.conj(self._bins[:, 1:2]), self._bins, np.conj(last_mirror)[:, np.newaxis]),
+                                axis=1)
+        windowed = before * padded[:, :-2] + centre * padded[:, 1:-1] + after * padded[:, 2:]
+        return self.frequencies, np.abs(windowed)
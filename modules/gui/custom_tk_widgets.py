@@ -157,6 +157,13 @@ class SlidingIndicator(tk.Frame):
         self.var.set(self.min)
         self.configure_state(state="disabled")
 
+    def set_value(self, value):
+        state = self.slider["state"]
+        self.slider.configure(state="normal")
+        self.slider.set(value)
+        self.var.set(value)
+        self.slider.configure(state=state)
+
 
 class Console(tk.scrolledtext.ScrolledText):
 
@@ -1,19 +1,22 @@
-from multiprocessing import Pool
 import matplotlib.pyplot as plt
 import numpy as np
 from modules.gui import custom_tk_widgets as cw
 from modules.backend import clinostat_com
 from datetime import datetime
 from shutil import copyfile
-from scipy import fft
 from tkinter import filedialog, messagebox
 import tkinter.ttk as ttk
 import tkinter as tk
 import threading
+import time
 import os
+import queue
 from modules.backend.data_socket import ServerStartupError
-from modules.backend.custom_thread import ClinostatSerialThread
-from typing import List
+from modules.backend.device_manager import DeviceHandle
+from modules.backend import rpm_sequence
+from modules.backend.spectrum import SlidingSpectrum
+from chamber.modules import telemetry
+from typing import List, Optional
 
 
 class InterfaceManager(ttk.Notebook):
@@ -61,11 +64,20 @@ class InterfaceManager(ttk.Notebook):
                                             text="TCP server control")
         self.interface.update(self.server_starter.interface)
 
-        self.serial_config.grid(row=0, column=0, padx=10, pady=10, sticky="nw", rowspan=4)
+        self.sequence_control = self.serial_access_modules["sequence"] =\
+            SequenceControl(master=self.motors_tab,
+                            supervisor=self.master,
+                            interface_manager=self,
+                            text="Speed sequence")
+        self.serial_sensitive_interface.update(self.sequence_control.serial_sensitive_interface)
+        self.interface.update(self.sequence_control.interface)
+
+        self.serial_config.grid(row=0, column=0, padx=10, pady=10, sticky="nw", rowspan=5)
         self.mode_options.grid(row=0, column=1, padx=10, pady=10, sticky="nw")
         self.pump_control.grid(row=1, column=1, padx=10, pady=10, sticky="nw")
         self.light_control.grid(row=2, column=1, padx=10, pady=10, sticky="nw")
         self.server_starter.grid(row=3, column=1, padx=10, pady=10, sticky="sw")
+        self.sequence_control.grid(row=4, column=1, padx=10, pady=10, sticky="nw")
 
         self.data_embed = DataEmbed(master=self, supervisor=self.master, interface_manager=self)
         self.interface.update(self.data_embed.interface)
@@ -79,9 +91,11 @@ class InterfaceManager(ttk.Notebook):
         self.add(self.data_embed, text="Diagnostics")
 
     def ui_modes_reset(self) -> None:
+        self.serial_interface_buffer = {}
         self.serial_sensitive_interface["connect"].configure(state="normal")
         self.serial_sensitive_interface["disconnect"].configure(state="disabled")
         self.ui_disable_command_buttons()
+        self.ui_sequence_disable()
         self.ui_disable_speed_Indicators()
         self.mode_options.reset_indicators()
         self.ui_watering_reset()
@@ -108,11 +122,66 @@ class InterfaceManager(ttk.Notebook):
         self.interface["speed_slider1"].configure_state(state="normal")
         self.interface["speed_slider2"].configure_state(state="normal")
 
-    def ui_device_connected(self) -> None:
+    def save_device_settings(self, handle: DeviceHandle) -> None:
+        handle.settings = {key: self.master.variables[key].get() for key in ("speed1", "speed2", "water1", "time1")}
+
+    def ui_show_device(self, handle: DeviceHandle) -> None:
+        # Rebuilds the controls from the state of the device, used when switching between devices.
+        self.serial_interface_buffer = {}
+        self.serial_config.update_device_menu()
+
+        if handle is None:
+            self.ui_modes_reset()
+            return
+
+        self.serial_sensitive_interface["connect"].configure(state="normal")
+        self.ui_device_state(handle)
+
+        sliders = {"speed1": "speed_slider1", "speed2": "speed_slider2", "water1": "water_slider1",
+                   "time1": "time_slider1"}
+        for key, slider in sliders.items():
+            if key in handle.settings:
+                self.interface[slider].set_value(handle.settings[key])
+            else:
+                self.interface[slider].set_value(self.interface[slider].min)
+
+        if handle.pumping:
+            self.ui_watering_started()
+        else:
+            self.ui_watering_enable()
+            self.master.variables["time_left_str"].set("00:00")
+
+    def ui_device_state(self, handle: DeviceHandle) -> None:
+        self.ui_disable_command_buttons()
         self.serial_sensitive_interface["disconnect"].configure(state="normal")
-        self.serial_sensitive_interface["connect"].configure(state="disabled")
-        self.ui_enable_run()
-        self.ui_watering_enable()
+
+        state = handle.device.state
+        if handle.device.res:
+            enabled = ["abort", "resume", "echo"]
+        elif state == "running":
+            enabled = ["abort", "pause", "echo"]
+        elif state == "stopping":
+            enabled = ["abort", "echo"]
+        else:
+            enabled = ["run", "echo"]
+
+        if handle.sequence:
+            enabled = [name for name in enabled if name != "run"] + ["abort"]
+            self.ui_sequence_running()
+        elif self.sequence_control.steps and "run" in enabled:
+            self.ui_sequence_enable()
+        else:
+            self.ui_sequence_disable()
+
+        for name in enabled:
+            self.serial_sensitive_interface[name].configure(state="normal")
+
+        if "run" in enabled:
+            self.ui_enable_speed_indicators()
+        else:
+            self.ui_disable_speed_Indicators()
+
+        self.mode_options.update_device_state(state or "-")
 
     def ui_run_handler(self) -> None:
         self.ui_disable_command_buttons()
@@ -125,6 +194,7 @@ class InterfaceManager(ttk.Notebook):
     def ui_pause_handler(self) -> None:
         self.ui_disable_command_buttons()
         self.ui_serial_suspend()
+        self.serial_sensitive_interface["abort"].configure(state="normal")  # Abort preempts the soft stop.
 
     def ui_resume_handler(self) -> None:
         self.serial_sensitive_interface["resume"].configure(state="disabled")
@@ -208,6 +278,18 @@ class InterfaceManager(ttk.Notebook):
         self.interface["water_slider1"].configure_state(state="normal")
         self.interface["time_slider1"].configure_state(state="normal")
 
+    def ui_sequence_enable(self) -> None:
+        self.serial_sensitive_interface["start_sequence"].configure(state="normal")
+        self.serial_sensitive_interface["stop_sequence"].configure(state="disabled")
+
+    def ui_sequence_running(self) -> None:
+        self.serial_sensitive_interface["start_sequence"].configure(state="disabled")
+        self.serial_sensitive_interface["stop_sequence"].configure(state="normal")
+
+    def ui_sequence_disable(self) -> None:
+        self.serial_sensitive_interface["start_sequence"].configure(state="disabled")
+        self.serial_sensitive_interface["stop_sequence"].configure(state="disabled")
+
     def ui_server_enable(self) -> None:
         self.interface["start_server"].configure(state="disabled")
         self.interface["close_server"].configure(state="normal")
@@ -258,9 +340,13 @@ class SerialConfig(ttk.LabelFrame):
 
         self.interface["refresh"].config(width=17)
 
+        self.interface["latency"] = tk.Button(self.port_menu_frame, command=self.report_latency,
+                                              text="Latency report", width=17)
+
         self.port_label.grid(row=0, column=0)
         self.port_menu.grid(row=1, column=0, pady=2)
         self.interface["refresh"].grid(row=2, column=0, pady=2)
+        self.interface["latency"].grid(row=3, column=0, pady=2)
 
         self.connections_frame = tk.Frame(self)
 
@@ -272,8 +358,18 @@ class SerialConfig(ttk.LabelFrame):
             tk.Button(self.connections_frame, command=self.disconnect_port,
                       text="Disconnect", width=17, state="disabled")
 
+        self.variables["active_device"] = tk.StringVar(self)
+        self.variables["active_device"].set("No device")
+
+        self.device_label = tk.Label(self.connections_frame, text="Shown device:")
+        self.device_menu = ttk.Combobox(self.connections_frame, textvariable=self.variables["active_device"],
+                                        state="readonly", width=18)
+        self.device_menu.bind("<<ComboboxSelected>>", self.select_device)
+
         self.interface["connect"].grid(row=0, column=0, pady=2)
         self.interface["disconnect"].grid(row=1, column=0, pady=2)
+        self.device_label.grid(row=2, column=0, pady=(10, 0))
+        self.device_menu.grid(row=3, column=0, pady=2)
 
         self.console = cw.Console(self, font=("normal", 10))
         self.console.configure(width=65, height=54)
@@ -288,51 +384,143 @@ class SerialConfig(ttk.LabelFrame):
 
     def refresh_ports(self) -> None:
 
-        self.available_ports = clinostat_com.get_ports()
-        if not self.available_ports:
-            self.available_ports = ["Empty"]
+        self.interface["refresh"].configure(state="disabled")
+        connected = tuple(self.supervisor.devices.port_names())
+        threading.Thread(target=self._discover_ports, args=(connected,), daemon=True).start()
+
+    def _discover_ports(self, connected: tuple) -> None:
+
+        # Only the serial ports are touched on this thread, the widgets are updated on the Tk thread.
+        discovery = self.supervisor.port_discovery
+        ports = discovery.candidates() or ["Empty"]
+        self.supervisor.call_soon(self._show_ports, ports)
 
+        # Ports in use are not probed, opening them again would interfere with the connected controllers.
+        found = discovery.probe([port for port in ports if port not in connected + ("Empty",)])
+        self.supervisor.call_soon(self._show_discovered, found)
+
+    def _show_ports(self, ports: list) -> None:
+
+        self.available_ports = ports
         self.port_menu["values"] = self.available_ports
         self.variables["ports"].set("Select serial port")
-        self.console.println("Updated available serial ports.", headline="SERIAL: ", msg_type="MESSAGE")
+
+    def _show_discovered(self, found: list) -> None:
+
+        if found:
+            self.variables["ports"].set(found[0])
+            self.console.println(f"Updated available serial ports, clinostat found on: {', '.join(found)}.",
+                                 headline="SERIAL: ", msg_type="MESSAGE")
+        else:
+            self.console.println("Updated available serial ports.", headline="SERIAL: ", msg_type="MESSAGE")
+        self.interface["refresh"].configure(state="normal")
 
     def connect_to_port(self) -> None:
 
         self.interface["connect"].configure(state="disabled")
-        if self.supervisor.params["device"] is not None:
-            self.supervisor.params["device"].close_serial()  # Not necessary.
-
         potential_port = self.variables["ports"].get()
+        discovery = self.supervisor.port_discovery
+        devices = self.supervisor.devices
+
+        if potential_port == "Select serial port" or potential_port == "Empty" or devices.get(potential_port):
+            # No port picked, look for a clinostat starting from where one was last connected.
+            potential_port = discovery.find_device(exclude=tuple(devices.port_names()))
+            if potential_port is None:
+                self.console.println("No ports to connect to.", headline="ERROR: ", msg_type="ERROR")
+                self.interface["connect"].configure(state="normal")
+                return
+            self.variables["ports"].set(potential_port)
+
+        if clinostat_com.Clinostat.try_connection(potential_port, timeout=discovery.timeout,
+                                                  protocol=discovery.protocol):
+            discovery.remember(potential_port)
+            handle = devices.connect(potential_port,
+                                     on_state=self.device_state_changed,
+                                     on_disconnect=self.heartbeat_lost)
+            handle.device.link_console(DeviceConsole(self.console, potential_port))
+            self.console.println(f"Successfully connected to {potential_port}.", headline="STATUS: ")
+            self.supervisor.select_device(potential_port)
 
-        if potential_port == "Select serial port" or potential_port == "Empty":
-            self.console.println("No ports to connect to.", headline="ERROR: ", msg_type="ERROR")
-            self.interface["connect"].configure(state="normal")
         else:
-            if clinostat_com.Clinostat.try_connection(potential_port):
-                self.supervisor.params["device"] = clinostat_com.Clinostat(potential_port)
-                self.supervisor.params["device"].port_name = potential_port
-                self.console.println(f"Successfully connected to {potential_port}.", headline="STATUS: ")
-                self.supervisor.params["device"].link_console(self.console)
-                self.interface_manager.ui_device_connected()
+            self.console.println("Connection to serial port failed.", headline="ERROR: ", msg_type="ERROR")
+            self.interface["connect"].configure(state="normal")
 
-            else:
-                self.console.println("Connection to serial port failed.", headline="ERROR: ", msg_type="ERROR")
-                self.interface["connect"].configure(state="normal")
+    def update_device_menu(self) -> None:
+        ports = self.supervisor.devices.port_names()
+        active = self.supervisor.devices.active
+        self.device_menu["values"] = ports
+        self.variables["active_device"].set(active.port_name if active else "No device")
+
+    def select_device(self, *args) -> None:
+        self.device_menu.selection_clear()
+        port_name = self.variables["active_device"].get()
+        if self.supervisor.devices.get(port_name):
+            self.supervisor.select_device(port_name)
+
+    def device_state_changed(self, handle: DeviceHandle, state: str) -> None:
+        # Called from the reader thread of the device.
+        self.supervisor.call_soon(self._show_device_state, handle, state)
+
+    def _show_device_state(self, handle: DeviceHandle, state: str) -> None:
+        if self.supervisor.devices.active is handle:
+            self.interface_manager.mode_options.update_device_state(state)
+
+    def heartbeat_lost(self, handle: DeviceHandle) -> None:
+        # Called from the heartbeat thread of the device.
+        self.supervisor.call_soon(self._device_lost, handle)
+
+    def _device_lost(self, handle: DeviceHandle) -> None:
+
+        self.console.println(f"Device on {handle.port_name} stopped responding. Check USB cable and update "
+                             f"serial ports.", headline="SERIAL ERROR: ", msg_type="ERROR")
+        self.supervisor.device_likely_unplugged(handle)
+
+    def report_latency(self) -> None:
+
+        handle = self.supervisor.devices.active
+        lines = handle.metrics.report_lines() if handle else []
+        if not lines:
+            self.console.println("No commands sent yet.", headline="LATENCY: ", msg_type="MESSAGE")
+            return
+
+        for line in lines:
+            self.console.println(line, headline="LATENCY: ", msg_type="MESSAGE")
+
+        date = str(datetime.now()).replace(".", "-").replace(" ", "-").replace(":", "-")
+        path = f"saved data/serial-latency-{date}.yaml"
+        try:
+            handle.metrics.dump(path, port_name=handle.port_name)
+        except OSError as err:
+            self.console.println(str(err), headline="ERROR: ", msg_type="ERROR")
+            return
+        self.console.println(f"Latency report saved to {path}.", headline="LATENCY: ", msg_type="MESSAGE")
 
     def disconnect_port(self) -> None:
 
+        handle = self.supervisor.devices.active
         try:
-            self.supervisor.params["device"].close_serial()
+            self.supervisor.devices.disconnect(handle)
         except clinostat_com.ClinostatCommunicationError as ex:
             self.console.println(ex.message, headline="ERROR: ", msg_type="ERROR")
             return
         finally:
-            port_name = self.supervisor.params["device"].port_name
-            self.supervisor.params["device"] = None
-            self.interface_manager.ui_modes_reset()
-            self.supervisor.flags["pumping"] = False
+            self.supervisor.show_active_device()
 
-        self.console.println(f"Successfully disconnected from {port_name}.", headline="STATUS: ")
+        self.console.println(f"Successfully disconnected from {handle.port_name}.", headline="STATUS: ")
+
+
+class DeviceConsole:
+
+    # Tags the messages of one device, all connected devices print to the same console.
+
+    def __init__(self, console, port_name: str):
+        self.console = console
+        self.port_name = port_name
+
+    def println(self, string, headline=None, msg_type="MESSAGE") -> None:
+        if headline is not None:
+            headline = f"{headline.rstrip(': ')} [{self.port_name}]: "
+        self.console.println(string, headline=headline, msg_type=msg_type)
 
 
 class ModeMenu(ttk.LabelFrame):
@@ -387,6 +575,10 @@ class ModeMenu(ttk.LabelFrame):
         # self.interface["home"].grid(row=4, column=0, pady=ModeMenu.button_pady)
         self.interface["echo"].grid(row=4, column=0, pady=ModeMenu.button_pady)
 
+        self.device_state = tk.StringVar(self, value="Device state: -")
+        self.state_label = tk.Label(self.button_frame, textvariable=self.device_state)
+        self.state_label.grid(row=5, column=0, pady=ModeMenu.button_pady)
+
         self.button_frame.grid(row=1, column=0, padx=10)
         self.indicators_frame.grid(row=0, column=1, padx=30, rowspan=3, sticky="NE")
 
@@ -402,38 +594,42 @@ class ModeMenu(ttk.LabelFrame):
 
     def handle_abort(self) -> None:
         self.interface_manager.ui_abort_handler()
-        ClinostatSerialThread(target=self.supervisor.params["device"].abort,
-                              serial_lock=self.supervisor.serial_lock,
-                              at_success=self.interface_manager.ui_enable_run,
-                              at_fail=self.supervisor.device_likely_unplugged).start()
+        self.interface_manager.sequence_control.stop_sequence()
+        self.supervisor.submit_command(self.supervisor.devices.active, "abort",
+                                       at_success=self.interface_manager.ui_enable_run)
 
     def handle_run(self) -> None:
         self.interface_manager.ui_run_handler()
         speed = self.read_indicator_values()
-        ClinostatSerialThread(target=self.supervisor.params["device"].run, args=(speed,),
-                              serial_lock=self.supervisor.serial_lock,
-                              at_success=self.interface_manager.ui_enable_stop,
-                              at_fail=self.supervisor.device_likely_unplugged).start()
+        self.supervisor.submit_command(self.supervisor.devices.active, "run", speed,
+                                       at_success=self.interface_manager.ui_enable_stop)
 
     def handle_echo(self) -> None:
 
-        ClinostatSerialThread(target=self.supervisor.params["device"].echo,
-                              at_start=self.interface_manager.ui_serial_suspend,
-                              serial_lock=self.supervisor.serial_lock,
-                              at_success=self.interface_manager.ui_serial_break_suspend,
-                              at_fail=self.supervisor.device_likely_unplugged).start()
+        device = self.supervisor.params["device"]
+        if device.state and device.state_age() < 2 * self.supervisor.heartbeat_interval:
+            # Kept up to date by the heartbeat, no need for a round trip.
+            device.console.println(f"Device is currently {device.state}.",
+                                   headline="CONTROLLER: ", msg_type="CONTROLLER")
+            return
+
+        self.supervisor.submit_command(self.supervisor.devices.active, "echo",
+                                       at_start=self.interface_manager.ui_serial_suspend,
+                                       at_success=self.interface_manager.ui_serial_break_suspend)
 
     def handle_pause(self) -> None:
         self.interface_manager.ui_pause_handler()
-        ClinostatSerialThread(target=self.supervisor.params["device"].pause,
-                              serial_lock=self.supervisor.serial_lock,
-                              at_success=self.interface_manager.ui_enable_resume,
-                              at_fail=self.supervisor.device_likely_unplugged).start()
+        if self.supervisor.params["sequence"]:
+            self.supervisor.params["sequence"].hold()
+        self.supervisor.submit_command(self.supervisor.devices.active, "pause",
+                                       at_success=self.interface_manager.ui_enable_resume)
 
     def handle_resume(self) -> None:
         self.interface_manager.ui_resume_handler()
         self.interface_manager.ui_disable_speed_Indicators()
-        self.supervisor.params["device"].resume()
+        self.supervisor.submit_command(self.supervisor.devices.active, "resume")
+        if self.supervisor.params["sequence"]:
+            self.supervisor.params["sequence"].release()
 
     def handle_home(self) -> None:
         self.supervisor.params["device"].home()
@@ -441,11 +637,107 @@ class ModeMenu(ttk.LabelFrame):
     def reset_indicators(self) -> None:
         for indicator in self.linear_indicators:
             indicator.reset()
+        self.device_state.set("Device state: -")
+
+    def update_device_state(self, state: str) -> None:
+        self.device_state.set(f"Device state: {state}")
+
+
+class SequenceControl(ttk.LabelFrame):
+
+    def __init__(self, supervisor, interface_manager, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.supervisor = supervisor
+        self.interface = {}
+        self.interface_manager = interface_manager
+        self.serial_sensitive_interface = {}
+        self.variables = {}
+        self.steps = []
+
+        self.interface["load_sequence"] = tk.Button(self, text="Load sequence", command=self.load_sequence, width=17)
+
+        self.interface["start_sequence"] = self.serial_sensitive_interface["start_sequence"] = \
+            tk.Button(self, text="Start sequence", command=self.start_sequence, width=17, state="disabled")
+
+        self.interface["stop_sequence"] = self.serial_sensitive_interface["stop_sequence"] = \
+            tk.Button(self, text="Stop sequence", command=self.stop_sequence, width=17, state="disabled")
+
+        self.variables["status"] = tk.StringVar(self, value="No sequence loaded.")
+        self.status_label = tk.Label(self, textvariable=self.variables["status"])
+
+        self.interface["load_sequence"].grid(row=0, column=0, padx=10, pady=5)
+        self.interface["start_sequence"].grid(row=0, column=1, padx=10, pady=5)
+        self.interface["stop_sequence"].grid(row=0, column=2, padx=10, pady=5)
+        self.status_label.grid(row=1, column=0, columnspan=3, pady=5)
+
+    def load_sequence(self) -> None:
+        filename = filedialog.askopenfilename(title="Load speed sequence",
+                                              filetypes=(("csv files", "*.csv"), ("all files", "*.*")))
+        if not filename:
+            return
+
+        try:
+            self.steps = rpm_sequence.load_sequence(filename)
+        except (OSError, ValueError) as err:
+            self.interface_manager.outputs["primary"].println(str(err), headline="ERROR: ", msg_type="ERROR")
+            return
+
+        self.variables["status"].set(f"Loaded {len(self.steps)} steps, {self.steps[-1].time:.0f} s.")
+        handle = self.supervisor.devices.active
+        if handle and not handle.sequence and handle.device.state in (None, "idle"):
+            self.interface_manager.ui_sequence_enable()
+
+    def start_sequence(self) -> None:
+        if self.supervisor.params["device"].state not in (None, "idle"):
+            self.interface_manager.outputs["primary"].println("Stop the motors before starting a sequence.",
+                                                              headline="ERROR: ", msg_type="ERROR")
+            return
+
+        handle = self.supervisor.devices.active
+        self.interface_manager.ui_sequence_running()
+        self.interface_manager.ui_run_handler()
+        handle.sequence = rpm_sequence.SequenceRunner(handle.worker,
+                                                      handle.device,
+                                                      self.steps,
+                                                      on_step=lambda report: self.report_step(handle, report),
+                                                      on_finish=lambda reports: self.report_finish(handle, reports),
+                                                      on_fail=lambda: self.supervisor.device_likely_unplugged(handle))
+        self.supervisor.params["sequence"] = handle.sequence
+        handle.sequence.start()
+
+    def stop_sequence(self) -> None:
+        handle = self.supervisor.devices.active
+        if handle and handle.sequence:
+            handle.sequence.stop()
+            handle.sequence = self.supervisor.params["sequence"] = None
+            self.variables["status"].set("Sequence stopped.")
+        if handle and self.steps:
+            self.interface_manager.ui_sequence_enable()
+
+    def report_step(self, handle: DeviceHandle, report: rpm_sequence.StepReport) -> None:
+        sequence = handle.sequence
+        if self.supervisor.devices.active is not handle or sequence is None:
+            return  # Shown again once the device is selected.
+        if report.index == 0:
+            self.interface_manager.ui_device_state(handle)
+        self.variables["status"].set(f"Step {report.index + 1}/{len(sequence.steps)}: "
+                                     f"{report.step.rpm1:.2f}/{report.step.rpm2:.2f} RPM, "
+                                     f"drift {report.drift * 1000:.0f} ms.")
+
+    def report_finish(self, handle: DeviceHandle, reports: list) -> None:
+        drifts = [abs(report.drift) for report in reports]
+        handle.device.console.println(f"Sequence finished, mean drift {sum(drifts) / len(drifts) * 1000:.0f} ms, "
+                                      f"max drift {max(drifts) * 1000:.0f} ms.", headline="SEQUENCE: ")
+        handle.sequence = None
+        if self.supervisor.devices.active is handle:
+            self.supervisor.params["sequence"] = None
+            self.interface_manager.ui_device_state(handle)
 
 
 class DataEmbed(tk.Frame):
 
     figsize_ = (5.7, 3.4)
+    REDRAW_INTERVAL = 0.1  # s
 
     def __init__(self, supervisor, interface_manager, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -454,7 +746,12 @@ class DataEmbed(tk.Frame):
         self.variables = {}
         self.plots = {}
         self.interface_manager = interface_manager
-        self.data_records_amount_default = 300
+        self.redraw_pending = False
+        self.last_redraw = 0.
+        self.spectrum = SlidingSpectrum(self.supervisor.spectrum_length, self.supervisor.sample_rate,
+                                        series=len(self.supervisor.data_buffers["grav_components"]),
+                                        window=self.supervisor.spectrum_window)
+        capacities = self.supervisor.data_buffers.capacities
 
         self.data_save_frame = ttk.LabelFrame(self, text="Save or discard data")
 
@@ -477,7 +774,8 @@ class DataEmbed(tk.Frame):
         for i in range(len(plot_descriptions)):
             self.plots[plot_keys[i]] = cw.EmbeddedFigure(master=self.gravity_plots,
                                                          figsize=DataEmbed.figsize_,
-                                                         tracking=True)
+                                                         tracking=True,
+                                                         maxrecords=capacities[plot_keys[i]])
             self.plots[plot_keys[i]].add_lines_object()
             self.plots[plot_keys[i]].add_lines_object()
             self.grav_axes.append(self.plots[plot_keys[i]])
@@ -498,7 +796,8 @@ class DataEmbed(tk.Frame):
 
         self.plots["temperatures"] = cw.EmbeddedFigure(master=self.temperatures,
                                                        figsize=DataEmbed.figsize_,
-                                                       tracking=True)
+                                                       tracking=True,
+                                                       maxrecords=capacities["temperatures"])
         for i in range(2):
             self.plots["temperatures"].add_lines_object()
 
@@ -511,7 +810,7 @@ class DataEmbed(tk.Frame):
                                                    figsize=DataEmbed.figsize_,
                                                    tracking=True,
                                                    style=".",
-                                                   maxrecords=10)
+                                                   maxrecords=capacities["humidity"])
         self.plots["humidity"].xlabel("Elapsed time (min)")
         self.plots["humidity"].ylabel("Humidity %")
         self.plots["humidity"].set_hard_y_limits([0, 100])
@@ -536,80 +835,87 @@ class DataEmbed(tk.Frame):
     def reset_data_buffers(self) -> None:
         self.supervisor.clear_queues()
         self.supervisor.reset_data_buffers()
+        self.supervisor.flags["new_data_present"] = False
+        self.redraw_pending = False
+        self.spectrum.reset()
 
-    def update_data(self) -> None:
+    def redraw_delay(self) -> float:
+        # s until a pending redraw is due.
+        return max(0., self.last_redraw + DataEmbed.REDRAW_INTERVAL - time.monotonic())
 
+    def read_queue(self) -> Optional[np.ndarray]:
+        # Everything received since the last tick as one array, a row per sample in the telemetry.SAMPLE_FIELDS order.
+        # None if nothing came in.
         data_queue = self.supervisor.get_queue
+        batches = []
+        for _ in range(data_queue.qsize()):  # Only what is there now, samples arriving meanwhile wait for the next tick.
+            try:
+                batches.append(data_queue.get_nowait())
+            except queue.Empty:
+                break
 
-        if not data_queue.empty():
-            self.supervisor.flags["new_data_present"] = True
-            message_string = data_queue.get()
-            values = [float(val) for val in message_string.split(";")]
-            index = 0
-            for key in self.supervisor.data_buffers:
-
-                for i, buffer in enumerate(self.supervisor.data_buffers[key]):
+        values = [sample.values for batch in batches for sample in batch]
+        if not values:
+            return None
+        return np.array(values, dtype=float)
 
-                    if key == "humidity" and values[index] == -100:
-                        pass
+    def update_data(self) -> None:
 
-                    else:
-                        temp = list(np.roll(buffer, -1))
-                        temp[-1] = values[index]
-                        self.supervisor.data_buffers[key][i] = temp
+        block = self.read_queue()
+        if block is not None:
+            index = 0
+            for key in self.supervisor.data_buffers:
 
+                for buffer in self.supervisor.data_buffers[key]:
+                    column = block[:, index]
+                    if key == "humidity":
+                        column = column[column != telemetry.NO_HUMIDITY_READING]
+                    buffer.extend(column)
                     index += 1
 
-            with open("temp/data.temp", "a") as file:
-                file.write(message_string)
-            data_queue.task_done()
-        else:
-            self.supervisor.flags["new_data_present"] = False
-
-        if self.supervisor.flags["new_data_present"]:  # If data buffers are not empty, plot.
-
-            # Update plots only if data tab is active.
-            if self.interface_manager.index(self.interface_manager.select()) == 1:
-                keys = ["grav_components", "grav_means"]
-                for plot_ind, plot in enumerate(self.grav_axes):
-                    for line, buffer in zip(plot.lines, self.supervisor.data_buffers[keys[plot_ind]]):
-                        plot.plot(line, np.arange(0, len(buffer)), buffer)
-
-                for line, buffer in zip(self.plots["temperatures"].lines, self.supervisor.data_buffers["temperatures"]):
-                    self.plots["temperatures"].plot(line, np.arange(0, len(buffer)), buffer)
-
-                obj = self.plots["humidity"]
-                buffer = self.supervisor.data_buffers["humidity"][0]
-                obj.plot(obj.lines[0], np.arange(0, len(buffer)), buffer)
-
-                if len(self.supervisor.data_buffers["grav_components"][0]) >= self.data_records_amount_default:
-                    pool = Pool(processes=3)
-                    result = pool.imap(fft.fft, self.supervisor.data_buffers["grav_components"])
-                    pool.close()
-                    pool.join()
-                    calculated_ffts = [fft_ for fft_ in result]
-                    for index, buffer in enumerate(calculated_ffts):
-                        N = len(self.supervisor.data_buffers["grav_components"][index])
-                        frt = fft.fft(self.supervisor.data_buffers["grav_components"][index])
-                        fr_domain = fft.fftfreq(N, 10)[:N // 2]
-                        self.plots["fourier"].plot(self.plots["fourier"].lines[index], fr_domain,
-                                                   np.abs(frt[:N // 2]))
+            self.spectrum.extend(block[:, :self.spectrum.series])  # The gravity vector comes first.
 
-        else:
+            self.supervisor.flags["new_data_present"] = True
+            self.redraw_pending = True
+
+        if not self.supervisor.flags["new_data_present"]:
             for plot in self.plots:
                 self.plots[plot].reset_plot()
+            return
+
+        # However fast the samples come in, the plots are redrawn at most every REDRAW_INTERVAL.
+        now = time.monotonic()
+        if not self.redraw_pending or now - self.last_redraw < DataEmbed.REDRAW_INTERVAL:
+            return
+        self.last_redraw = now
+        self.redraw_pending = False
+
+        # Update plots only if data tab is active.
+        if self.interface_manager.index(self.interface_manager.select()) == 1:
+            keys = ["grav_components", "grav_means"]
+            for plot_ind, plot in enumerate(self.grav_axes):
+                for line, buffer in zip(plot.lines, self.supervisor.data_buffers[keys[plot_ind]]):
+                    plot.plot(line, np.arange(0, len(buffer)), buffer.view())
+
+            for line, buffer in zip(self.plots["temperatures"].lines, self.supervisor.data_buffers["temperatures"]):
+                self.plots["temperatures"].plot(line, np.arange(0, len(buffer)), buffer.view())
+
+            obj = self.plots["humidity"]
+            buffer = self.supervisor.data_buffers["humidity"][0]
+            obj.plot(obj.lines[0], np.arange(0, len(buffer)), buffer.view())
+
+            frequencies, magnitudes = self.spectrum.magnitudes()
+            for line, magnitude in zip(self.plots["fourier"].lines, magnitudes):
+                self.plots["fourier"].plot(line, frequencies, magnitude)
 
     def clear_data(self) -> None:
         if messagebox.askyesno(title="Clinostat control system", message="Are you sure you want to clear all data?"):
-            if "data.temp" in os.listdir("temp"):
-                os.remove("temp/data.temp")
-                with open("temp/data.temp", "a"):
-                    pass
+            self.supervisor.recorder.clear()
             self.reset_data_buffers()
             self.update_data()
 
     def save_file(self) -> None:
-        if self.supervisor.data_buffers["grav_components"][0] != self.supervisor.data_buffers.default_primer:
+        if not self.supervisor.data_buffers.empty():
             date = datetime.now()
             date = str(date).replace(".", "-").replace(" ", "-").replace(":", "-")
             try:
@@ -637,7 +943,6 @@ class PumpControl(ttk.LabelFrame):
         self.interface_manager = interface_manager
         self.serial_sensitive_interface = {}
         self.variables = {}
-        self.device = supervisor.params["device"]
 
         self.interface["water_slider1"] = cw.SlidingIndicator(master=self, label="Watering volume", unit="ml",
                                                               orientation="horizontal", from_=0, to=250, res=10,
@@ -692,8 +997,13 @@ class PumpControl(ttk.LabelFrame):
 
     def start_watering_cycle(self) -> None:
         if self.interface["water_slider1"].get_value() > 0 and self.interface["time_slider1"].get_value() > 0:
-            self.supervisor.flags["pumping"] = True
+            handle = self.supervisor.devices.active
+            handle.water_volume = self.interface["water_slider1"].get_value()
+            handle.water_interval = self.interface["time_slider1"].get_value()
+            handle.pump_time = time.time()
+            handle.pumping = True
             self.interface_manager.ui_watering_started()
+            self.supervisor.wake()
 
         else:
             self.interface_manager.outputs["primary"].println("Time and water volume values"
@@ -701,18 +1011,17 @@ class PumpControl(ttk.LabelFrame):
                                                               headline="ERROR: ", msg_type="ERROR")
 
     def stop_watering_cycle(self) -> None:
-        self.supervisor.flags["pumping"] = False
+        self.supervisor.devices.active.pumping = False
         self.variables["time_left"].set("00:00")
         self.interface_manager.ui_watering_stopped()
 
     def force_watering_cycle(self) -> None:
+        self.water_device(self.supervisor.devices.active, self.interface["water_slider1"].get_value())
 
-        ClinostatSerialThread(target=self.supervisor.params["device"].dump_water,
-                              at_start=self.interface_manager.ui_serial_suspend,
-                              serial_lock=self.supervisor.serial_lock,
-                              at_success=self.interface_manager.ui_serial_break_suspend,
-                              at_fail=self.supervisor.device_likely_unplugged,
-                              args=(self.interface["water_slider1"].get_value(),)).start()
+    def water_device(self, handle: DeviceHandle, volume: float) -> None:
+        self.supervisor.submit_command(handle, "dump_water", volume,
+                                       at_start=self.interface_manager.ui_serial_suspend,
+                                       at_success=self.interface_manager.ui_serial_break_suspend)
 
 
 class LightControl(ttk.LabelFrame):
@@ -747,11 +1056,9 @@ class LightControl(ttk.LabelFrame):
         self.interface["light_slider1"] = self.intensity_slider_red
         self.interface["light_slider2"] = self.intensity_slider_blue
 
-        self.intensity_queue = self.supervisor.put_queue
-
     def update_value_container(self, *args) -> None:
         msg = f'{self.intensity_slider_red.get_value()};{self.intensity_slider_blue.get_value()}'
-        self.intensity_queue.put(msg)
+        self.supervisor.params["server"].push_control(msg)
 
 
 class ServerStarter(ttk.LabelFrame):
@@ -797,10 +1104,12 @@ class ServerStarter(ttk.LabelFrame):
         except ServerStartupError:
             return
 
+        self.supervisor.telemetry.reset_metrics()
         self.interface_manager.ui_server_enable()
-        self.supervisor.variables["address"].set(server.address + ":" + str(server.port))
+        self.supervisor.variables["address"].set(server.endpoint)
         self.supervisor.flags["plotting"] = True
         self.interface_manager.ui_lighting_enable()
+        self.supervisor.wake()
 
     def handle_close_server(self) -> None:
         self.interface_manager.ui_lighting_disable()
@@ -808,6 +1117,17 @@ class ServerStarter(ttk.LabelFrame):
         self.supervisor.flags["plotting"] = False
         self.supervisor.params["server"].close_server()
         self.supervisor.variables["address"].set("")
+        self.report_ingest()
+
+    def report_ingest(self) -> None:
+        for name, metrics in self.supervisor.telemetry.metrics().items():
+            self.interface_manager.outputs["primary"].println(
+                f"{name}: {metrics['received']} frames received, {metrics['dropped']} dropped ({metrics['policy']}), "
+                f"buffer high-water {metrics['high_water']}/{metrics['maxsize']}.", headline="TCP: ", msg_type="TCP")
+
+        control = self.supervisor.params["server"].control_report()
+        if control:
+            self.interface_manager.outputs["primary"].println(control, headline="TCP: ", msg_type="TCP")
 
 
 if __name__ == "__main__":
@@ -1,5 +1,7 @@
 import time
+import numpy as np
 from collections.abc import MutableMapping
+from typing import Optional
 
 
 class ProgramProperties(MutableMapping):
@@ -27,6 +29,9 @@ class AppProperties(ProgramProperties):
 
     __slots__ = (
         "device",
+        "serial_worker",
+        "heartbeat",
+        "sequence",
         "plotter",
         "server"
     )
@@ -56,7 +61,6 @@ class AppTrackers(ProgramProperties):
 
     __slots__ = (
         "seconds",
-        "pump_time"
     )
 
     def __init__(self):
@@ -67,9 +71,7 @@ class AppTrackers(ProgramProperties):
 class AppFlags(ProgramProperties):
 
     __slots__ = (
-        "pumping",
         "plotting",
-        "prev_pumping_flag_state",
         "new_data_present"
     )
 
@@ -78,6 +80,43 @@ class AppFlags(ProgramProperties):
             setattr(self, atr, False)
 
 
+class RingBuffer:
+
+    # The last `capacity` values of a series, oldest first, zeros until it fills up. Every value is stored twice, at
+    # i and i + capacity, so the values in order are always one contiguous slice of the array: appending is O(1) and
+    # view() doesn't copy. A view is only valid until the next append.
+
+    def __init__(self, capacity: int, dtype=float):
+        self.capacity = capacity
+        self._data = np.zeros(2 * capacity, dtype=dtype)
+        self._start = 0
+        self.count = 0  # Values appended, up to the capacity.
+
+    def append(self, value) -> None:
+        self._data[self._start] = self._data[self._start + self.capacity] = value
+        self._start = (self._start + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def extend(self, values) -> None:
+        values = np.asarray(values, dtype=self._data.dtype)[-self.capacity:]
+        positions = (self._start + np.arange(len(values))) % self.capacity
+        self._data[positions] = values
+        self._data[positions + self.capacity] = values
+        self._start = (self._start + len(values)) % self.capacity
+        self.count = min(self.count + len(values), self.capacity)
+
+    def view(self) -> np.ndarray:
+        view = self._data[self._start:self._start + self.capacity]
+        view.flags.writeable = False
+        return view
+
+    def __array__(self, dtype=None, copy=None):
+        return self.view() if dtype is None else self.view().astype(dtype)
+
+    def __len__(self):
+        return self.capacity
+
+
 class DataBuffers(ProgramProperties):
 
     __slots__ = (
@@ -87,17 +126,18 @@ class DataBuffers(ProgramProperties):
         "humidity"
     )
 
-    def __init__(self):
+    CAPACITIES = {"grav_components": 300, "grav_means": 300, "temperatures": 300, "humidity": 10}
+    SERIES = {"grav_components": 3, "grav_means": 3, "temperatures": 3, "humidity": 1}
 
-        self.MEASUREMENT_NUM_DEFAULT = 300
-        self.default_primer = [0 for _ in range(self.MEASUREMENT_NUM_DEFAULT)]
+    def __init__(self, capacities: Optional[dict] = None):
 
-        self.HUMID_MEASUREMENT_NUM = 10
-        self.humid_primer = [0 for _ in range(self.HUMID_MEASUREMENT_NUM)]
+        # Number of values kept per series, DATA_BUFFER_CAPACITIES in config.yaml.
+        self.capacities = dict(DataBuffers.CAPACITIES, **(capacities or {}))
 
-        setattr(self, "grav_components", [self.default_primer, self.default_primer, self.default_primer])
-        setattr(self, "grav_means", [self.default_primer, self.default_primer, self.default_primer])
-        setattr(self, "temperatures", [self.default_primer, self.default_primer, self.default_primer])
-        setattr(self, "humidity", [self.humid_primer])
+        for key in self.__slots__:
+            setattr(self, key, [RingBuffer(self.capacities[key]) for _ in range(DataBuffers.SERIES[key])])
         # setattr(self, "light", [[]])
         # setattr(self, "time_humidity", [[]])
+
+    def empty(self) -> bool:
+        return not any(buffer.count for key in self.__slots__ for buffer in self[key])
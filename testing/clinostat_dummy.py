@@ -0,0 +1,301 @@
+import os
+import pty
+import select
+import threading
+import time
+import tty
+from typing import Optional
+from modules.backend.clinostat_protocol import COMMAND_LAYOUTS, START_OF_FRAME, MAX_FRAME_LENGTH, FramedCodec, crc8
+from modules.backend.clinostat_mechanics import rpm_to_timer_interval, ramp_steps, ramp_duration, steps_after
+
+# Software stand-in for the clinostat controller. It mirrors the command handling and the driver state machine of
+# firmware/src/clinostat-stepper-driver.cpp on a pseudo-terminal, so Clinostat(simulator.port_name) connects to it
+# like to the real device.
+
+# firmware/include/commands.hpp
+
+RUN_COMMAND = 0x01
+HOME_COMMAND = 0x02
+ABORT_COMMAND = 0x03
+PAUSE_COMMAND = 0x04
+RESUME_COMMAND = 0x05
+ECHO_COMMAND = 0x06
+CONNECT_COMMAND = 0x07
+DISCONNECT_COMMAND = 0x08
+BEGIN_WATERING_COMMAND = 0x09
+
+CLINOSTAT_CONNECTED = 0x01
+TOP_SPEED_REACHED = 0x02
+STEPPERS_STARTING = 0x03
+STOPPING_STEPPERS = 0x04
+STEPPERS_STOPPED = 0x05
+RUNNING_MODE_REPORT = 0x06
+STOPPING_MODE_REPORT = 0x07
+IDLE_MODE_REPORT = 0x08
+WATERING_STARTED = 0x09
+STILL_WATERING = 0x0A
+
+# firmware/include/driver_states.hpp
+
+IDLE = 0
+RUNNING = 1
+PAUSED = 2
+SOFT_STOPPING = 3
+ABORT = 4
+
+# firmware/include/pump_config.hpp
+
+PUMPING_CONSTANT = 200  # ml/min
+
+
+class _Stepper:
+
+    def __init__(self):
+        self.top_steps = 1
+        self.ramp_start = 0.
+        self.ramp_down_end = None
+
+    def start(self, rpm: float, now: float) -> None:
+        self.top_steps = ramp_steps(rpm_to_timer_interval(rpm))
+        self.ramp_start = now
+        self.ramp_down_end = None
+
+    def steps(self, now: float) -> float:
+        return min(self.top_steps, steps_after(now - self.ramp_start))
+
+    def top_speed_time(self) -> float:
+        return self.ramp_start + ramp_duration(self.top_steps)
+
+    def stop(self, now: float) -> None:
+        self.ramp_down_end = now + ramp_duration(self.steps(now))
+
+
+class ClinostatSimulator:
+
+    def __init__(self, time_scale: float = 1., report_top_speed: bool = False):
+
+        # time_scale < 1 shortens ramps and watering for stress tests. The firmware has the top speed report
+        # commented out, it can be turned on here to exercise unsolicited messages.
+        self.time_scale = time_scale
+        self.report_top_speed = report_top_speed
+
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port_name = os.ttyname(self._slave)
+
+        self.status = IDLE
+        self.connected = False
+        self.pumping = False
+        self.speeds = [0., 0.]
+        self.commands_handled = 0
+        self.framed_link = False  # Set by the first valid frame, until disconnect.
+        self.crc_errors = 0
+
+        self._steppers = [_Stepper(), _Stepper()]
+        self._top_speed_reported = True
+        self._pump_end = 0.
+        self._buffer = bytearray()
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "ClinostatSimulator":
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._running = False
+        if self._thread:
+            self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _loop(self) -> None:
+        while self._running:
+            readable, _, _ = select.select([self._master], [], [], self._next_deadline())
+            if readable:
+                try:
+                    self._buffer += os.read(self._master, 1024)
+                except OSError:
+                    return
+                self._handle_serial()
+            self._check_motor_status()
+
+    def _now(self) -> float:
+        return time.monotonic() / self.time_scale
+
+    def _next_deadline(self) -> float:
+        now = self._now()
+        deadlines = [0.05]
+        if self.status == SOFT_STOPPING:
+            deadlines += [stepper.ramp_down_end - now for stepper in self._steppers]
+        if not self._top_speed_reported:
+            deadlines += [stepper.top_speed_time() - now for stepper in self._steppers]
+        if self.pumping:
+            deadlines.append(self._pump_end - now)
+        return max(0., min(deadlines) * self.time_scale)
+
+    def _write(self, byte: int) -> None:
+        if self.framed_link:
+            os.write(self._master, FramedCodec.encode(byte, layouts={}))
+        else:
+            os.write(self._master, bytes((byte,)))
+
+    def _handle_serial(self) -> None:
+        while self._buffer:
+            if self._buffer[0] == START_OF_FRAME:
+                if not self._handle_frame():
+                    return
+                continue
+
+            if self.framed_link:
+                del self._buffer[:1]  # Bytes outside of a frame are line noise once the link is framed.
+                continue
+
+            command = self._buffer[0]
+            layout = COMMAND_LAYOUTS.get(command) if self.connected else None
+            payload_size = layout.size if layout else 0
+
+            if len(self._buffer) < 1 + payload_size:
+                return  # The firmware would block reading the rest of the payload.
+
+            payload = bytes(self._buffer[1:1 + payload_size])
+            del self._buffer[:1 + payload_size]
+            self.commands_handled += 1
+            self._handle_command(command, payload)
+
+    def _handle_frame(self) -> bool:
+        # Returns False while the frame is incomplete. Invalid frames are consumed the same way the firmware reads
+        # them and dropped, the controller then waits for the next start of frame.
+        if len(self._buffer) < 2:
+            return False
+
+        length = self._buffer[1]
+        if not 0 < length <= MAX_FRAME_LENGTH:
+            del self._buffer[:2]
+            return True
+
+        if len(self._buffer) < length + 3:
+            return False
+
+        frame = bytes(self._buffer[1:length + 3])
+        del self._buffer[:length + 3]
+        if crc8(frame, 0, length + 1) != frame[-1]:
+            self.crc_errors += 1
+            return True
+
+        command = frame[1]
+        layout = COMMAND_LAYOUTS.get(command)
+        if (layout.size if layout else 0) != length - 1:
+            return True
+
+        self.framed_link = True
+        self.commands_handled += 1
+        self._handle_command(command, frame[2:-1])
+        return True
+
+    def _handle_command(self, command: int, payload: bytes) -> None:
+
+        if command == CONNECT_COMMAND:
+            self._write(CLINOSTAT_CONNECTED)
+            self.connected = True
+
+        elif command == DISCONNECT_COMMAND:
+            self._update_status(ABORT)
+            self.connected = False
+            self.framed_link = False
+            self.pumping = False
+
+        elif self.connected:
+
+            if command == RUN_COMMAND:
+                self.speeds = list(COMMAND_LAYOUTS[RUN_COMMAND].unpack(payload))
+                self._update_status(RUNNING)
+
+            elif command == BEGIN_WATERING_COMMAND:
+                volume, = COMMAND_LAYOUTS[BEGIN_WATERING_COMMAND].unpack(payload)
+                if self.pumping:
+                    self._write(STILL_WATERING)
+                else:
+                    self._write(WATERING_STARTED)
+                    self.pumping = True
+                    self._pump_end = self._now() + volume / PUMPING_CONSTANT * 60
+
+            elif command == ABORT_COMMAND:
+                self._update_status(ABORT)
+
+            elif command == PAUSE_COMMAND:
+                self._update_status(SOFT_STOPPING)
+
+            elif command == RESUME_COMMAND:
+                self._update_status(RUNNING)
+
+            elif command == ECHO_COMMAND:
+                report = {IDLE: IDLE_MODE_REPORT,
+                          RUNNING: RUNNING_MODE_REPORT,
+                          SOFT_STOPPING: STOPPING_MODE_REPORT}.get(self.status)
+                if report is not None:
+                    self._write(report)
+
+    def _update_status(self, new_status: int) -> None:
+        now = self._now()
+
+        if new_status == IDLE:
+            if self.status in (SOFT_STOPPING, ABORT):
+                if self.connected:
+                    self._write(STEPPERS_STOPPED)
+                self.status = IDLE
+
+        elif new_status == RUNNING:
+            if self.status in (PAUSED, IDLE):
+                self.status = RUNNING
+                for stepper, speed in zip(self._steppers, self.speeds):
+                    stepper.start(speed, now)
+                self._top_speed_reported = False
+                self._write(STEPPERS_STARTING)
+
+        elif new_status in (PAUSED, SOFT_STOPPING):
+            if self.status == RUNNING:
+                self.status = SOFT_STOPPING
+                for stepper in self._steppers:
+                    stepper.stop(now)
+                self._top_speed_reported = True
+                self._write(STOPPING_STEPPERS)
+
+        elif new_status == ABORT:
+            if self.status in (RUNNING, SOFT_STOPPING):
+                self.status = ABORT
+                self._top_speed_reported = True
+
+    def _check_motor_status(self) -> None:
+        now = self._now()
+
+        if self.pumping and now >= self._pump_end:
+            self.pumping = False
+
+        if self.status == ABORT:
+            self._update_status(IDLE)
+
+        elif self.status == SOFT_STOPPING:
+            if all(stepper.ramp_down_end <= now for stepper in self._steppers):
+                self._update_status(IDLE)
+
+        elif self.status == RUNNING and not self._top_speed_reported:
+            if all(stepper.top_speed_time() <= now for stepper in self._steppers):
+                self._top_speed_reported = True
+                if self.report_top_speed:
+                    self._write(TOP_SPEED_REACHED)
+
+
+if __name__ == "__main__":
+
+    simulator = ClinostatSimulator().start()
+    print(f"Simulated clinostat listening on {simulator.port_name}")
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.stop()
@@ -0,0 +1,203 @@
+import argparse
+import asyncio
+import multiprocessing
+import queue
+import random
+import threading
+import time
+from typing import List, Optional
+from modules.backend.data_socket import DataServer
+from modules.backend.framing import HEADER_SIZE, encode_frame
+from modules.backend.ingest import IngestBuffer
+from chamber.modules import telemetry
+
+# Load generator for DataServer. Simulated chambers run in separate processes, so the CPU time measured in this
+# process is the server and the consumer of the receive queue only. Every chamber speaks the same protocol as
+# chamber_controller.py: HELLO, then batches of samples, with the control channel unless --no-push is given.
+#
+#   python -m testing.data_server_benchmark --chambers 50 --rate 20 --batch 4 --duration 30
+#
+# Latency is measured from the sample timestamp to the moment it is taken from the receive queue, so it includes the
+# time a sample waits for its batch. The text format carries no timestamps, only throughput is measured for it.
+
+
+async def _chamber(args, deadline: float) -> int:
+    if args.socket:
+        reader, writer = await asyncio.open_unix_connection(args.socket)
+    else:
+        reader, writer = await asyncio.open_connection(args.address, args.port)
+
+    offered = (args.format, telemetry.TEXT) if args.no_push else (args.format, telemetry.TEXT, telemetry.PUSH)
+    writer.write(encode_frame(telemetry.encode_hello(offered), HEADER_SIZE))
+    accepted = telemetry.decode_hello(await _read_frame(reader))
+    sample_format = accepted[0] if accepted else telemetry.TEXT
+    push = bool(accepted) and telemetry.PUSH in accepted
+
+    period = args.batch / args.rate
+    next_frame = time.monotonic() + random.random() * period  # Chambers don't all send at the same moment.
+    seq = 0
+    sent = 0
+    while time.monotonic() < deadline:
+        await asyncio.sleep(max(0., next_frame - time.monotonic()))
+        next_frame += period
+
+        # Timestamped as if sampled at the rate, the oldest one has waited for the whole batch.
+        now = time.time()
+        batch = []
+        for age in range(args.batch - 1, -1, -1):
+            values = [random.random() for _ in telemetry.SAMPLE_FIELDS]
+            batch.append(telemetry.Sample(seq, now - age / args.rate, values))
+            seq += 1
+        payload = telemetry.encode_batch(batch, sample_format)
+
+        if push:
+            writer.write(encode_frame(telemetry.KIND_SAMPLES + payload, HEADER_SIZE))
+            await writer.drain()
+        else:
+            writer.write(encode_frame(payload, HEADER_SIZE))
+            await _read_frame(reader)
+        sent += 1
+
+    writer.close()
+    return sent
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> bytes:
+    size = int(await reader.readexactly(HEADER_SIZE))
+    return await reader.readexactly(size)
+
+
+async def _run_chambers(indices: List[int], args, deadline: float) -> int:
+    results = await asyncio.gather(*(_chamber(args, deadline) for _ in indices), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            print(f"Chamber failed: {result!r}")
+    return sum(result for result in results if isinstance(result, int))
+
+
+def _client_process(indices: List[int], args, deadline: float, sent) -> None:
+    count = asyncio.run(_run_chambers(indices, args, deadline))
+    with sent.get_lock():
+        sent.value += count
+
+
+class Consumer(threading.Thread):
+
+    # Stands in for the GUI, takes every batch from the receive queue and records the latency of its samples.
+
+    def __init__(self, buffer: IngestBuffer):
+        super().__init__(daemon=True)
+        self.buffer = buffer
+        self.frames = 0
+        self.samples = 0
+        self.latencies = []
+        self._running = True
+
+    def stop(self) -> None:
+        self._running = False
+
+    def run(self) -> None:
+        while self._running:
+            try:
+                batch = self.buffer.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            now = time.time()
+            self.frames += 1
+            self.samples += len(batch)
+            self.latencies.extend(now - sample.timestamp for sample in batch if sample.timestamp is not None)
+
+
+def _percentile(sorted_values: list, percent: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(percent / 100 * (len(sorted_values) - 1))))]
+
+
+def run_benchmark(args) -> dict:
+    buffer = IngestBuffer(maxsize=args.queue_size, policy=args.policy)
+    server = DataServer(args.address, args.port, socket_path=args.socket)
+    server.attach_receive_queue(buffer)
+    server.run_server()
+    consumer = Consumer(buffer)
+    consumer.start()
+
+    sent = multiprocessing.Value("q", 0)
+    deadline = time.monotonic() + args.warmup + args.duration
+    chambers = list(range(args.chambers))
+    processes = [multiprocessing.Process(target=_client_process,
+                                         args=(chambers[i::args.processes], args, deadline, sent))
+                 for i in range(min(args.processes, args.chambers))]
+    for process in processes:
+        process.start()
+
+    # Measured after the warmup, once every chamber has connected.
+    time.sleep(args.warmup)
+    frames, samples, latencies = consumer.frames, consumer.samples, len(consumer.latencies)
+    buffer.reset_metrics()
+    start, cpu_start = time.perf_counter(), time.process_time()
+    depths = []
+    while time.perf_counter() - start < args.duration:
+        time.sleep(0.1)
+        depths.append(buffer.qsize())
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+    frames, samples = consumer.frames - frames, consumer.samples - samples
+    measured = sorted(consumer.latencies[latencies:])
+    metrics = buffer.metrics()
+
+    for process in processes:
+        process.join()
+    consumer.stop()
+    server.close_server()
+
+    return {"chambers": args.chambers,
+            "frames_per_s": frames / elapsed,
+            "samples_per_s": samples / elapsed,
+            "frames_sent": sent.value,
+            "latency_ms": {name: None if value is None else value * 1000
+                           for name, value in (("p50", _percentile(measured, 50)),
+                                               ("p95", _percentile(measured, 95)),
+                                               ("p99", _percentile(measured, 99)),
+                                               ("max", measured[-1] if measured else None))},
+            "queue_depth": {"mean": sum(depths) / len(depths) if depths else 0, "high_water": metrics["high_water"],
+                            "dropped": metrics["dropped"]},
+            "cpu_percent": cpu / elapsed * 100,
+            "cpu_us_per_frame": cpu / frames * 1e6 if frames else None,
+            "cpu_us_per_sample": cpu / samples * 1e6 if samples else None}
+
+
+def print_report(report: dict) -> None:
+    latency = report["latency_ms"]
+    print(f"{report['chambers']} chambers: {report['frames_per_s']:.0f} frames/s, "
+          f"{report['samples_per_s']:.0f} samples/s ({report['frames_sent']} frames sent)")
+    if latency["p50"] is not None:
+        print(f"latency p50={latency['p50']:.2f} ms, p95={latency['p95']:.2f} ms, p99={latency['p99']:.2f} ms, "
+              f"max={latency['max']:.2f} ms")
+    depth = report["queue_depth"]
+    print(f"queue depth mean={depth['mean']:.1f}, high-water={depth['high_water']}, dropped={depth['dropped']}")
+    if report["cpu_us_per_frame"] is not None:
+        print(f"server cpu {report['cpu_percent']:.1f}%, {report['cpu_us_per_frame']:.1f} us/frame, "
+              f"{report['cpu_us_per_sample']:.1f} us/sample")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="DataServer throughput and latency benchmark.")
+    parser.add_argument("--chambers", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=5., help="Samples per second of every chamber.")
+    parser.add_argument("--batch", type=int, default=1, help="Samples per frame.")
+    parser.add_argument("--format", choices=telemetry.FORMATS, default=telemetry.BINARY_V1)
+    parser.add_argument("--no-push", action="store_true", help="Answer every frame, like for older chambers.")
+    parser.add_argument("--duration", type=float, default=10., help="Measured time, s.")
+    parser.add_argument("--warmup", type=float, default=2., help="s")
+    parser.add_argument("--processes", type=int, default=max(1, multiprocessing.cpu_count() - 1),
+                        help="Processes the chambers are spread over.")
+    parser.add_argument("--address", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8899)
+    parser.add_argument("--socket", default=None, help="Unix socket path, instead of TCP.")
+    parser.add_argument("--queue-size", type=int, default=IngestBuffer.MAXSIZE)
+    parser.add_argument("--policy", choices=IngestBuffer.POLICIES, default=IngestBuffer.DROP_OLDEST)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    print_report(run_benchmark(parse_args()))